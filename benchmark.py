@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the inside-outside implementation on synthetic data.
+
+A random CNF grammar and a random corpus are generated from the given
+sizes (number of nonterminals, size of the vocabulary, sentence length,
+number of sentences), and every stage of training is timed on them:
+reading the grammar files, compiling the grammar, the inside and outside
+passes, per-sentence training updates and Viterbi parsing, plus the dense
+NumPy engine if requested. For each stage the time, the sentences per
+second, the peak memory allocated and a checksum of its results are
+reported.
+
+Results can be saved as JSON and compared against later runs: the
+comparison shows the speedup of every stage and fails if a checksum has
+changed, i. e. if an optimization changed the results.
+
+Usage: python benchmark.py --nonterminals 20 --vocab 200 --length 15
+       --sentences 100 --save baseline.json
+       python benchmark.py ... --compare baseline.json
+"""
+
+import argparse, collections, json, os, platform, random, shutil, sys, \
+tempfile, time, tracemalloc
+
+import insideoutside as io
+
+def generate_grammar(n_nts, n_words, tags_per_word=2, density=1.0, \
+seed=None):
+
+    """ Generates a random CNF grammar. Every nonterminal keeps each of its
+        possible binary rules with probability density (at least one), and
+        every word is produced by tags_per_word random nonterminals; rule
+        probabilities are random and normalized per left-hand side.
+        Input: number of nonterminals (the first is S), size of the
+               vocabulary, preterminals per word, share of binary rules kept,
+               random seed
+        Output: unary and binary rules and nonterminals, as returned by
+                read_grammar()
+    """
+    rng = random.Random(seed)
+    nts = ['S'] + ['N' + str(k) for k in range(1, n_nts)]
+    words = ['w' + str(k) for k in range(0, n_words)]
+
+    binary_rules = []
+    for nt_start in nts:
+        pairs = [(nt_left, nt_right) for nt_left in nts for nt_right in nts \
+        if rng.random() < density]
+        if not pairs:
+            pairs = [(rng.choice(nts), rng.choice(nts))]
+        weights = [rng.random() + 1e-3 for pair in pairs]
+        total = sum(weights)
+        for (nt_left, nt_right), weight in zip(pairs, weights):
+            binary_rules.append((nt_start, nt_left, nt_right, weight / total))
+
+    tags = dict((nt, []) for nt in nts)
+    for word in words:
+        for nt in rng.sample(nts, min(tags_per_word, len(nts))):
+            tags[nt].append((word, rng.random() + 1e-3))
+    unary_rules = []
+    for nt in nts:
+        total = sum(weight for word, weight in tags[nt])
+        for word, weight in tags[nt]:
+            unary_rules.append((nt, word, weight / total))
+
+    return unary_rules, binary_rules, nts
+
+def generate_corpus(unary_rules, n_sents, length, min_length=None, \
+seed=None):
+
+    """ Generates random sentences over the words of a grammar.
+        Input: unary rules, number of sentences, maximum sentence length,
+               minimum sentence length (default: the maximum), random seed
+        Output: list of sentences as lists of words
+    """
+    rng = random.Random(seed)
+    words = sorted(set(unary_rule[1] for unary_rule in unary_rules))
+    if min_length is None:
+        min_length = length
+    return [[rng.choice(words) for i in \
+    range(0, rng.randint(min_length, length))] for s in range(0, n_sents)]
+
+def write_grammar_files(unary_rules, binary_rules, nts, directory):
+
+    """ Writes a grammar as the input files of read_grammar().
+        Input: unary and binary rules, nonterminals, target directory
+        Output: ---
+    """
+    words = sorted(set(unary_rule[1] for unary_rule in unary_rules))
+    with open(os.path.join(directory, 'nonterminals.txt'), 'w') as o:
+        o.write(''.join(nt + '\n' for nt in nts))
+    with open(os.path.join(directory, 'terminals.txt'), 'w') as o:
+        o.write(''.join(word + '\n' for word in words))
+    with open(os.path.join(directory, 'pcfg.txt'), 'w') as o:
+        o.writelines(' '.join([rule[0], '->', rule[1], rule[2], \
+        repr(rule[3])]) + '\n' for rule in binary_rules)
+        o.writelines(' '.join([rule[0], '->', rule[1], repr(rule[2])]) + \
+        '\n' for rule in unary_rules)
+
+def measure(stage, repeat, memory):
+
+    """ Times a stage and measures its peak memory.
+        Input: function running the stage and returning its checksum,
+               number of timed runs (the fastest counts), whether to make an
+               extra run under tracemalloc
+        Output: seconds, peak memory in KiB (or None), checksum
+    """
+    seconds = None
+    for r in range(0, repeat):
+        start = time.perf_counter()
+        checksum = stage()
+        elapsed = time.perf_counter() - start
+        if seconds is None or elapsed < seconds:
+            seconds = elapsed
+
+    peak = None
+    if memory:
+        tracemalloc.start()
+        try:
+            stage()
+            peak = tracemalloc.get_traced_memory()[1] / 1024.0
+        finally:
+            tracemalloc.stop()
+
+    return seconds, peak, checksum
+
+def run_benchmarks(unary_rules, binary_rules, nts, sents, engines, \
+batch_size=16, repeat=1, memory=True):
+
+    """ Runs every stage on a grammar and a corpus.
+        Input: unary and binary rules, nonterminals, list of sentences,
+               engines to benchmark ('python', 'numpy'), batch size of the
+               dense engine, number of timed runs, whether to measure memory
+        Output: dictionary of stage name -> results (seconds, sentences per
+                second, peak memory in KiB, checksum)
+    """
+    directory = tempfile.mkdtemp()
+    write_grammar_files(unary_rules, binary_rules, nts, directory)
+    grammar = io.Grammar(unary_rules, binary_rules, nts)
+    charts = [io.inside(words, grammar) for words in sents]
+
+    def read_grammar():
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            rules = io.read_grammar()
+        finally:
+            os.chdir(cwd)
+        return len(rules[1]) + sum(rule[-1] for rule in rules[1])
+
+    def compile_grammar():
+        compiled = io.Grammar(unary_rules, binary_rules, nts)
+        return sum(compiled.binary_probs)
+
+    def inside():
+        total = 0.0
+        for words in sents:
+            inside_probs, scales = io.inside(words, grammar)
+            log_prob = io.sentence_log_prob(inside_probs, scales, grammar)
+            total += log_prob or 0.0
+        return total
+
+    def outside():
+        numerators = [0.0] * len(grammar.binary)
+        denominators = [0.0] * len(grammar.symbols)
+        for words, (inside_probs, scales) in zip(sents, charts):
+            io.outside(words, inside_probs, scales, grammar, numerators, \
+            denominators)
+        return sum(numerators)
+
+    def train_iterate():
+        trained = io.Grammar(unary_rules, binary_rules, nts)
+        for words in sents:
+            trained.binary_probs = io.train_iterate(words, trained)
+        return sum(trained.binary_probs)
+
+    def viterbi():
+        return sum(io.viterbi(words, grammar)[1] or 0.0 for words in sents)
+
+    stages = [('read_grammar', read_grammar, False), ('compile', \
+    compile_grammar, False)]
+    if 'python' in engines:
+        stages += [('inside', inside, True), ('outside', outside, True), \
+        ('train_iterate', train_iterate, True), ('viterbi', viterbi, True)]
+
+    if 'numpy' in engines:
+        if io.np is None:
+            print("The 'numpy' engine requires NumPy to be installed")
+            sys.exit(-1)
+        dense = io.DenseGrammar(grammar)
+        batches = list(io.sentence_batches(sents, batch_size))
+
+        def inside_dense():
+            total = 0.0
+            for batch in batches:
+                total += float(io.inside_dense(batch, dense)[0].sum())
+            return total
+
+        def expected_counts_dense():
+            total = 0.0
+            for batch in batches:
+                total += float(io.expected_counts_dense(batch, dense)[0].sum())
+            return total
+
+        stages += [('inside_dense', inside_dense, True), \
+        ('expected_counts_dense', expected_counts_dense, True)]
+
+    results = collections.OrderedDict()
+    for name, stage, per_sentence in stages:
+        seconds, peak, checksum = measure(stage, repeat, memory)
+        results[name] = {'seconds': seconds, 'sentences_per_sec': \
+        len(sents) / seconds if per_sentence and seconds > 0 else None, \
+        'peak_kib': peak, 'checksum': checksum}
+    shutil.rmtree(directory)
+    return results
+
+def print_results(results, baseline=None, tolerance=1e-6):
+
+    """ Prints benchmark results, compared to a baseline if given.
+        Input: results of run_benchmarks(), optional baseline results,
+               relative tolerance of the checksums
+        Output: names of the stages whose checksum differs from the baseline
+    """
+    changed = []
+    print('%-22s %10s %12s %12s' % ('stage', 'seconds', 'sentences/s', \
+    'peak KiB') + ('  speedup' if baseline else ''))
+    for name, result in results.items():
+        line = '%-22s %10.4f %12s %12s' % (name, result['seconds'], \
+        '%.1f' % result['sentences_per_sec'] if result['sentences_per_sec'] \
+        else '-', '%.0f' % result['peak_kib'] if result['peak_kib'] is not \
+        None else '-')
+        if baseline and name in baseline:
+            line += '  %6.2fx' % (baseline[name]['seconds'] / \
+            result['seconds'])
+            old, new = baseline[name]['checksum'], result['checksum']
+            if abs(new - old) > tolerance * max(abs(old), abs(new), 1.0):
+                line += '  CHANGED (' + repr(old) + ' -> ' + repr(new) + ')'
+                changed.append(name)
+        print(line)
+    return changed
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmarks of the '
+    'inside-outside implementation on a synthetic grammar and corpus')
+    parser.add_argument('--nonterminals', type=int, default=10,
+    help='number of nonterminals')
+    parser.add_argument('--vocab', type=int, default=100, help='number of '
+    'words')
+    parser.add_argument('--tags-per-word', type=int, default=2,
+    help='number of preterminals producing each word')
+    parser.add_argument('--density', type=float, default=1.0, help='share '
+    'of all possible binary rules in the grammar')
+    parser.add_argument('--length', type=int, default=10, help='(maximum) '
+    'sentence length')
+    parser.add_argument('--min-length', type=int, help='minimum sentence '
+    'length (default: --length)')
+    parser.add_argument('--sentences', type=int, default=50, help='number '
+    'of sentences')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of '
+    'the grammar and the corpus')
+    parser.add_argument('--engines', nargs='+', default=['python'],
+    choices=['python', 'numpy'], help='engines to benchmark')
+    parser.add_argument('--batch-size', type=int, default=16, help='batch '
+    'size of the numpy engine')
+    parser.add_argument('--repeat', type=int, default=1, help='timed runs '
+    'per stage; the fastest counts')
+    parser.add_argument('--no-memory', action='store_true', help='skip the '
+    'peak memory measurements')
+    parser.add_argument('--save', metavar='FILE', help='save the results as '
+    'JSON')
+    parser.add_argument('--compare', metavar='FILE', help='compare with '
+    'results saved earlier; fails if any result changed')
+    args = parser.parse_args()
+
+    config = {'nonterminals': args.nonterminals, 'vocab': args.vocab, \
+    'tags_per_word': args.tags_per_word, 'density': args.density, \
+    'length': args.length, 'min_length': args.min_length, 'sentences': \
+    args.sentences, 'seed': args.seed, 'batch_size': args.batch_size}
+    baseline = None
+    if args.compare:
+        try:
+            with open(args.compare) as f:
+                saved = json.load(f)
+        except IOError:
+            print("Could not find file '" + args.compare + "'")
+            sys.exit(-1)
+        if saved['config'] != config:
+            print("'" + args.compare + "' was run with different settings: " \
+            + json.dumps(saved['config'], sort_keys=True))
+            sys.exit(-1)
+        baseline = saved['results']
+
+    unary_rules, binary_rules, nts = generate_grammar(args.nonterminals, \
+    args.vocab, args.tags_per_word, args.density, args.seed)
+    sents = generate_corpus(unary_rules, args.sentences, args.length, \
+    args.min_length, args.seed)
+    print(len(binary_rules), 'binary and', len(unary_rules), 'unary rules,', \
+    len(sents), 'sentences,', sum(len(words) for words in sents), 'words\n')
+
+    results = run_benchmarks(unary_rules, binary_rules, nts, sents, \
+    args.engines, args.batch_size, args.repeat, not args.no_memory)
+    changed = print_results(results, baseline)
+
+    if args.save:
+        with open(args.save, 'w') as o:
+            json.dump({'config': config, 'python': platform.python_version(), \
+            'results': results}, o, indent=2, sort_keys=True)
+    if changed:
+        print('\nResults changed:', ', '.join(changed))
+        sys.exit(-1)
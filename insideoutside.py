@@ -32,204 +32,1311 @@ The final set of rules with probabilities will be produced in output.txt
 @author: Ádám Varga
 """
 
-import os.path, sys
+import argparse, array, heapq, itertools, json, locale, math, mmap, \
+multiprocessing, os, pickle, random, shutil, struct, sys, tempfile, time
 
-def inside(words, unary_rules, binary_rules, nts):
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# terminal whose unary rules are used for unknown words under the 'unk'
+# policy
+UNKNOWN_WORD = '<unk>'
+
+# what to do with a word that has no unary rule: 'ignore' (leave its chart
+# cell empty, so the sentence has no parse and is not learned from),
+# 'error' (stop with an error), 'uniform' (any preterminal, each with
+# probability 1 / vocabulary size) or 'unk' (use the unary rules of the
+# UNKNOWN_WORD terminal)
+UNKNOWN_WORD_POLICIES = ('ignore', 'error', 'uniform', 'unk')
+
+# counters a Grammar accumulates while it is trained on: pruned cells and
+# the sum of the fractions of their inside mass that were discarded,
+# sentences seen and parsed and the log probability of the latter, filled
+# chart entries, seconds spent in the inside pass, the counting outside
+# pass and re-estimation, and rule updates without evidence because the
+# parent was never used (zero denominator); name and initial value
+GRAMMAR_STATS = (('pruned_cells', 0), ('discarded_mass', 0.0), \
+('sentences', 0), ('parsed_sentences', 0), ('log_likelihood', 0.0), \
+('chart_items', 0), ('inside_time', 0.0), ('outside_time', 0.0), \
+('reestimate_time', 0.0), ('fallback_rules', 0))
+
+class Grammar(object):
+    
+    """ Integer-coded PCFG with rule tables indexed for chart computations.
+        Input: unary and binary rules, nonterminals; optionally the
+        vocabulary of an encoded corpus, in which case terminals are
+        replaced by their index in it (-1 if missing) to match the integer
+        sentences of that corpus; the policy for words without unary rules
+        (see UNKNOWN_WORD_POLICIES); chart pruning settings (see
+        prune_cell())
+        Symbols are numbered in order of appearance (nonterminals first).
+        Binary rule k of the grammar is binary_rules[k]; its probability is
+        kept in binary_probs[k] so that it can be updated in place.
+    """
+    
+    def __init__(self, unary_rules, binary_rules, nts, vocab=None, \
+    unknown_words='ignore', prune_threshold=0.0, beam=None):
+        self.symbols = []
+        self.ids = {}
+        for nt in nts:
+            self.symbol_id(nt)
+        self.start = self.symbol_id('S')
+        
+        # unary rules as (nonterminal id, word, probability)
+        self.unary_rules = list(unary_rules)
+        self.unary = []
+        if vocab is not None:
+            word_ids = dict((word, k) for k, word in enumerate(vocab))
+        for unary_rule in unary_rules:
+            word = unary_rule[1]
+            if vocab is not None:
+                word = word_ids.get(word, -1)
+            self.unary.append((self.symbol_id(unary_rule[0]), word, \
+            unary_rule[2]))
+        
+        # lexicon[word] -> [(nonterminal id, probability)]; terminals
+        # missing from the vocabulary (-1) never occur in a sentence
+        self.lexicon = {}
+        for nt, word, prob in self.unary:
+            if prob > 0 and word != -1:
+                self.lexicon.setdefault(word, []).append((nt, prob))
+        
+        # preterminals standing in for words missing from the lexicon
+        self.vocab = vocab
+        self.unknown_words = unknown_words
+        self.unknown = []
+        if unknown_words == 'uniform':
+            preterminals = sorted(set(nt for nt, word, prob in self.unary))
+            terminals = set(unary_rule[1] for unary_rule in unary_rules if \
+            unary_rule[2] > 0)
+            prob = 1.0 / max(len(terminals), 1)
+            self.unknown = [(nt, prob) for nt in preterminals]
+        elif unknown_words == 'unk':
+            self.unknown = [(self.ids[unary_rule[0]], unary_rule[2]) for \
+            unary_rule in unary_rules if unary_rule[1] == UNKNOWN_WORD and \
+            unary_rule[2] > 0]
+        # word -> (scaled diagonal cell, log scale), see preterminals()
+        self.lexical_cache = {}
+        
+        # pruning settings
+        self.prune_threshold = prune_threshold
+        self.beam = beam
+        self.pruning = prune_threshold > 0.0 or beam is not None
+        # training counters, see GRAMMAR_STATS
+        for name, zero in GRAMMAR_STATS:
+            setattr(self, name, zero)
+        
+        # binary rules as (parent id, left id, right id) + probabilities
+        self.binary = []
+        self.binary_probs = []
+        for binary_rule in binary_rules:
+            self.binary.append((self.symbol_id(binary_rule[0]), \
+            self.symbol_id(binary_rule[1]), self.symbol_id(binary_rule[2])))
+            self.binary_probs.append(binary_rule[3])
+        
+        # by_children[left][right] -> [(rule index, parent)]
+        # by_parent[parent][left] -> [(rule index, right)]
+        self.by_children = {}
+        self.by_parent = {}
+        for k, (nt_start, nt_left, nt_right) in enumerate(self.binary):
+            self.by_children.setdefault(nt_left, {}) \
+            .setdefault(nt_right, []).append((k, nt_start))
+            self.by_parent.setdefault(nt_start, {}) \
+            .setdefault(nt_left, []).append((k, nt_right))
+    
+    def unknown_word(self, word):
+        """ Handles a word without unary rules according to the unknown
+            word policy; exits if the policy is 'error'.
+            Output: list of (nonterminal id, probability)"""
+        if self.unknown_words == 'error':
+            if self.vocab is not None and 0 <= word < len(self.vocab):
+                word = self.vocab[word]
+            print("Unknown word '" + str(word) + "'")
+            sys.exit(-1)
+        return self.unknown
+    
+    def preterminals(self, word):
+        """ Returns the scaled diagonal chart cell of a word and its log
+            scale; cells are built once per word and shared by all
+            sentences, and must not be modified."""
+        entry = self.lexical_cache.get(word)
+        if entry is None:
+            rules = self.lexicon.get(word)
+            if rules is None:
+                rules = self.unknown_word(word)
+            cell = {}
+            for nt, prob in rules:
+                cell[nt] = prob
+            entry = (cell, normalize_cell(cell))
+            self.lexical_cache[word] = entry
+        return entry
+    
+    def stats(self):
+        
+        """Training counters (see GRAMMAR_STATS) as a dictionary."""
+        return dict((name, getattr(self, name)) for name, zero in \
+        GRAMMAR_STATS)
+    
+    def add_stats(self, stats):
+        
+        """Adds counters, e. g. those of a worker process, to this grammar's.
+           Input: dictionary as returned by stats()"""
+        for name, zero in GRAMMAR_STATS:
+            setattr(self, name, getattr(self, name) + stats[name])
+        
+    def symbol_id(self, symbol):
+        """ Returns the integer code of a symbol, registering it if needed."""
+        if symbol not in self.ids:
+            self.ids[symbol] = len(self.symbols)
+            self.symbols.append(symbol)
+        return self.ids[symbol]
+    
+    def binary_rules(self):
+        """ Returns the binary rules as (A, B, C, p) tuples with current
+            probabilities."""
+        return [(self.symbols[nt_start], self.symbols[nt_left], \
+        self.symbols[nt_right], self.binary_probs[k]) for k, (nt_start, \
+        nt_left, nt_right) in enumerate(self.binary)]
+
+def empty_chart(n):
+    
+    """ Creates an empty n*n chart.
+        Input: sentence length
+        Output: list of lists of empty dicts
+    """
+    return [[{} for j in range(0, n)] for i in range(0, n)]
+
+# log scale factors are clipped to this value to avoid overflow; larger
+# factors only ever multiply (near) zero probabilities
+MAX_LOG_SCALE = 700.0
+
+def scale_factor(log_scale):
+    
+    """ Converts a log scale difference into a multiplicative factor.
+        Input: log of the factor
+        Output: float
+    """
+    return math.exp(min(log_scale, MAX_LOG_SCALE))
+
+def normalize_cell(cell):
+    
+    """ Rescales the entries of a chart cell so that the largest is 1.0.
+        Input: dict of probabilities
+        Output: log of the factor the entries were divided by
+    """
+    if not cell:
+        return 0.0
+    top = max(cell.values())
+    for nt in cell:
+        cell[nt] /= top
+    return math.log(top)
+
+def prune_cell(cell, threshold, beam):
+    
+    """ Removes the entries of a normalized chart cell that are below the
+        threshold (relative to the largest entry) or smaller than the beam
+        most probable ones (ties are kept).
+        Input: dict of scaled probabilities, threshold, beam width or None
+        Output: fraction of the mass of the cell that was removed
+    """
+    total = sum(cell.values())
+    kept = [(nt, p) for nt, p in cell.items() if p >= threshold]
+    if beam is not None and len(kept) > beam:
+        floor = heapq.nlargest(beam, [p for nt, p in kept])[-1]
+        kept = [(nt, p) for nt, p in kept if p >= floor]
+    if len(kept) == len(cell):
+        return 0.0
+    
+    cell.clear()
+    cell.update(kept)
+    return (total - sum(cell.values())) / total
+
+def lexical_chart(words, grammar):
+    
+    """ Creates a chart whose main diagonal holds the scaled preterminal
+        cells of the words (see Grammar.preterminals()).
+        Input: sentence as list of words, compiled grammar
+        Output: chart and table of log scales
+    """
+    n = len(words)
+    chart = empty_chart(n)
+    scales = [[0.0] * n for i in range(0, n)]
+    for i in range(0, n):
+        cell, scales[i][i] = grammar.preterminals(words[i])
+        chart[i][i] = dict(cell)
+    return chart, scales
+
+def fill_cell(chart, scales, i, j, grammar, backs=None):
+    
+    """ Fills the chart cell of span [i, j] from the cells of its children.
+        Entries are the sum over the ways of building them (inside
+        probabilities), or, if backs is given, the best of them, whose
+        rule index and split point are kept in backs (Viterbi). Only
+        children present in the chart are combined, and splits are brought
+        to the scale of the most probable one. The cell is then scaled so
+        that its largest entry is 1.0, and pruned with prune_cell() unless
+        it spans the whole sentence.
+        Input: chart and log scales (filled below the span), span, compiled
+               grammar, optionally the dict of backpointers of the cell
+        Output: ---
+    """
+    by_children, probs = grammar.by_children, grammar.binary_probs
+    cell = chart[i][j]
+    splits = [(d, scales[i][d] + scales[d + 1][j]) for d in range(i, j) if \
+    chart[i][d] and chart[d + 1][j]]
+    if not splits:
+        return
+    top = max(split_scale for d, split_scale in splits)
+    for d, split_scale in splits:
+        factor = math.exp(split_scale - top)
+        right_cell = chart[d + 1][j]
+        for nt_left, p_left in chart[i][d].items():
+            rights = by_children.get(nt_left)
+            if rights is None:
+                continue
+            for nt_right, p_right in right_cell.items():
+                rules = rights.get(nt_right)
+                if rules is None:
+                    continue
+                p_children = p_left * p_right * factor
+                for k, nt_start in rules:
+                    prob = probs[k] * p_children
+                    if backs is None:
+                        if prob > 0:
+                            cell[nt_start] = cell.get(nt_start, 0.0) + prob
+                    elif prob > cell.get(nt_start, 0.0):
+                        cell[nt_start] = prob
+                        backs[nt_start] = (k, d)
+    scales[i][j] = top + normalize_cell(cell)
+    if grammar.pruning and (i > 0 or j < len(chart) - 1):
+        grammar.pruned_cells += 1
+        grammar.discarded_mass += prune_cell(cell, grammar.prune_threshold, \
+        grammar.beam)
+
+def inside(words, grammar):
     
     """ Calculates inside probbilities.
-        Input: sentence as list of words, unary and binary rules, nonterminals
-        Output: table of inside probabilities
+        Every cell is scaled so that its largest entry is 1.0, and the log
+        of the scaling factor is kept in scales[i][j], i. e. the inside
+        probability of A over [i, j] is inside_probs[i][j][A] * 
+        exp(scales[i][j]). This keeps long sentences from underflowing.
+        If the grammar has pruning enabled, every span but the whole
+        sentence is pruned with prune_cell() as soon as it is complete.
+        Input: sentence as list of words, compiled grammar
+        Output: table of scaled inside probabilities, keyed by nonterminal
+                id, and table of log scales
     """    
-    # initialize empty n*n matrix   
-    inside_probs = []
-    new = []
-    for i in range(0, len(words)):
-        for j in range(0, len(words)):
-            new.append({})
-        inside_probs.append(new)
-        new = []
-    
+    n = len(words)
     # fill main diagonal with unary rule probabilities
-    for i in range(0, len(words)):
-        for unary_rule in unary_rules:
-            if unary_rule[1] == words[i]:
-                inside_probs[i][i][unary_rule[0]] = unary_rule[2]
+    inside_probs, scales = lexical_chart(words, grammar)
                 
     # fill diagonals starting from main diagonal, going towards upper
     # right-hand corner
-    j = 1
-    while j < len(words):
-        for i in range(0, len(words)):
-            if (i + j) < len(words):
-                # check for all possible binary rules
-                for nt_left in nts:
-                    for nt_right in nts:
-                        for binary_rule in binary_rules:
-                            if binary_rule[1] == nt_left and binary_rule[2] \
-                            == nt_right:
-                                sum_prob = 0
-                                # add up probabilities corresponding to the 
-                                # rule
-                                for d in range(i, i + j):
-                                    if nt_left in inside_probs[i][d].keys() \
-                                    and nt_right in \
-                                    inside_probs[d + 1][i + j].keys():
-                                        sum_prob += binary_rule[3] * \
-                                        inside_probs[i][d][nt_left] * \
-                                        inside_probs[d + 1][i +j][nt_right]
-                                        
-                                if sum_prob > 0:
-                                    if binary_rule[0] in \
-                                    inside_probs[i][i + j].keys():
-                                        inside_probs[i][i + j][binary_rule[0]]\
-                                        += sum_prob
-                                    else:
-                                        inside_probs[i][i + j][binary_rule[0]]\
-                                        = sum_prob                            
-        j += 1
-        
-
-    return inside_probs
-        
-def outside(words, inside_probs, binary_rules, nts):
+    for j in range(1, n):
+        for i in range(0, n - j):
+            fill_cell(inside_probs, scales, i, i + j, grammar)
+
+    return inside_probs, scales
+
+def sentence_log_prob(inside_probs, scales, grammar):
+    
+    """ Computes the log probability of a sentence from its inside chart.
+        Input: scaled inside chart and log scales, compiled grammar
+        Output: log probability, or None if the sentence has no parse
+    """
+    n = len(inside_probs)
+    root = inside_probs[0][n - 1].get(grammar.start, 0.0) if n else 0.0
+    if root <= 0.0:
+        return None
+    return math.log(root) + scales[0][n - 1]
+        
+def outside(words, inside_probs, scales, grammar, numerators=None, \
+denominators=None):
     
     """ Calculates outside probbilities.
-        Input: sentence as list of words, table of inside probabilities,
-        binary rules, nonterminals
-        Output: table of outside probabilities
+        The outside value of a cell is relative to the sentence probability
+        P and the inside scale of the same cell: the outside probability of
+        A over [i, j] is outside_probs[i][j][A] * P / exp(scales[i][j]).
+        Mass is pushed top-down from parents to children, and only items
+        with nonzero inside probability are visited or filled. If
+        numerators and denominators are given, the expected rule counts of
+        the sentence (see expected_counts()) are added to them in the same
+        pass.
+        Input: sentence as list of words, scaled inside chart and log
+        scales, compiled grammar, optionally count accumulators
+        Output: table of scaled outside probabilities, keyed by nonterminal
+                id
     """    
-
-    # initialize empty n*n matrix   
-    outside_probs = []
-    new = []
-    for i in range(0, len(words)):
-        for j in range(0, len(words)):
-            new.append({})
-        outside_probs.append(new)
-        new = []
+    n = len(words)
+    outside_probs = empty_chart(n)
+    by_parent, probs = grammar.by_parent, grammar.binary_probs
+    counting = numerators is not None
     
     # default upper right-hand corner rule
-    outside_probs[0][len(words) - 1]['S'] = 1.0
-    
-    # fill diagonals starting from the upper right-hand corner, going towards
-    # main diagonal
-    j = len(words) - 1 
-    while j >= 0:
-        for i in range(0, len(words)):
-            if (i + j) < len(words):
-                # check rules to the right
-                for nt_start in nts:
-                    for nt_right in nts:
-                        for binary_rule in binary_rules:
-                            if binary_rule[0] == nt_start and binary_rule[2] \
-                            == nt_right and binary_rule[1] != nt_right:
-                                sum_prob = 0
-                                # add up probabilities corresponding to the 
-                                # rule
-                                for e in range(i + j + 1, len(words)):
-                                    if nt_start in outside_probs[i][e].keys() \
-                                    and nt_right in \
-                                    inside_probs[i + j + 1][e].keys():
-                                        sum_prob += binary_rule[3] * \
-                                        outside_probs[i][e][nt_start] * \
-                                        inside_probs[i + j + 1][e][nt_right]
-                                if sum_prob > 0:
-                                    if binary_rule[1] in \
-                                    outside_probs[i][i + j].keys():
-                                        outside_probs[i][i + j] \
-                                        [binary_rule[1]] += sum_prob
-                                    else:
-                                        outside_probs[i][i + j] \
-                                        [binary_rule[1]] = sum_prob
-                                        
-                # check rules above
-                for nt_start in nts:
-                    for nt_left in nts:
-                        for binary_rule in binary_rules:
-                            if binary_rule[0] == nt_start and binary_rule[1] \
-                            == nt_left:
-                                sum_prob = 0
-                                # add up probabilities corresponding to the 
-                                # rule
-                                for e in range(0, i):
-                                    if nt_start in \
-                                    outside_probs[e][i + j].keys() and \
-                                    nt_left in inside_probs[e][i - 1].keys():
-                                        sum_prob += binary_rule[3] * \
-                                        outside_probs[e][i + j][nt_start] * \
-                                        inside_probs[e][i - 1][nt_left]
-                                if sum_prob > 0:
-                                    if binary_rule[2] in \
-                                    outside_probs[i][i + j].keys():
-                                        outside_probs[i][i + j] \
-                                        [binary_rule[2]] += sum_prob
-                                    else:
-                                        outside_probs[i][i + j] \
-                                        [binary_rule[2]] = sum_prob                        
-        
-        j -= 1
+    root = inside_probs[0][n - 1].get(grammar.start, 0.0)
+    if root <= 0.0:
+        return outside_probs
+    outside_probs[0][n - 1][grammar.start] = 1.0 / root
+    
+    # go through parent spans starting from the upper right-hand corner,
+    # towards the main diagonal; the outside values of a span are final
+    # once it is reached
+    for j in range(n - 1, 0, -1):
+        for i in range(0, n - j):
+            parents = outside_probs[i][i + j]
+            if not parents:
+                continue
+            if counting:
+                in_parents = inside_probs[i][i + j]
+                for nt_start, p_out in parents.items():
+                    denominators[nt_start] += p_out * in_parents[nt_start]
+            for d in range(i, i + j):
+                left_cell = inside_probs[i][d]
+                right_cell = inside_probs[d + 1][i + j]
+                if not left_cell or not right_cell:
+                    continue
+                factor = scale_factor(scales[i][d] + scales[d + 1][i + j] - \
+                scales[i][i + j])
+                out_left = outside_probs[i][d]
+                out_right = outside_probs[d + 1][i + j]
+                for nt_start, p_out in parents.items():
+                    lefts = by_parent.get(nt_start)
+                    if lefts is None:
+                        continue
+                    p_out = p_out * factor
+                    for nt_left, p_left in left_cell.items():
+                        for k, nt_right in lefts.get(nt_left, ()):
+                            p_right = right_cell.get(nt_right)
+                            if p_right is None:
+                                continue
+                            prob = probs[k] * p_out
+                            if prob > 0:
+                                out_left[nt_left] = \
+                                out_left.get(nt_left, 0.0) + prob * p_right
+                                out_right[nt_right] = \
+                                out_right.get(nt_right, 0.0) + prob * p_left
+                                if counting:
+                                    numerators[k] += prob * p_left * p_right
+    
+    # preterminals are never parents of binary rules
+    if counting:
+        for i in range(0, n):
+            for nt, p_out in outside_probs[i][i].items():
+                denominators[nt] += p_out * inside_probs[i][i][nt]
         
     return outside_probs
 
-def train_iterate(words, inside_probs, outside_probs, binary_rules):
+def expected_counts(words, grammar, numerators=None, denominators=None):
     
-    """Performs a training iteration based on inside-outside algorithm
-       Input: sentence as list of words, table of insie and outside 
-              probabilities, binary rules
-       Output: updated set of binary rules
+    """Computes the expected rule counts of one sentence with an inside
+       and a counting outside pass; the counts are normalized by the
+       sentence probability, so a sentence without a parse contributes
+       nothing; the log probability of the sentence and the other training
+       counters (see GRAMMAR_STATS) are added to the grammar's
+       Input: sentence as list of words, compiled grammar; optionally the
+              numerators and denominators to add to
+       Output: numerators (expected uses of each binary rule, in grammar
+               order) and denominators (expected uses of each nonterminal,
+               by id)
     """
+    if numerators is None:
+        numerators = [0.0] * len(grammar.binary)
+    if denominators is None:
+        denominators = [0.0] * len(grammar.symbols)
     
-    updated_rules = []
+    start = time.perf_counter()
+    inside_probs, scales = inside(words, grammar)
+    middle = time.perf_counter()
+    grammar.inside_time += middle - start
+    grammar.sentences += 1
+    grammar.chart_items += sum(len(cell) for row in inside_probs for cell in \
+    row)
+    log_prob = sentence_log_prob(inside_probs, scales, grammar)
+    if log_prob is not None:
+        grammar.log_likelihood += log_prob
+        grammar.parsed_sentences += 1
+    outside(words, inside_probs, scales, grammar, numerators, denominators)
+    grammar.outside_time += time.perf_counter() - middle
+    return numerators, denominators
 
-    for binary_rule in binary_rules:
-        numerator = 0
-        for i in range(0, len(words)):
-            for j in range(i + 1, len(words)):
-                if binary_rule[0] in outside_probs[i][j].keys():
-                        inside_sum = 0
-                        for d in range(i, j):
-                            if binary_rule[1] in inside_probs[i][d].keys() \
-                            and binary_rule[2] in inside_probs[d + 1][j].keys():
-                                inside_sum += \
-                                inside_probs[i][d][binary_rule[1]] * \
-                                inside_probs[d + 1][j][binary_rule[2]]                                
-                        outside_sum = outside_probs[i][j][binary_rule[0]] * \
-                        binary_rule[3]
-                        numerator += inside_sum * outside_sum
-        
-        denominator = 0
-        for i in range(0, len(words)):
-            for j in range(i, len(words)):
-                if binary_rule[0] in outside_probs[i][j].keys() and \
-                binary_rule[0] in inside_probs[i][j].keys():
-                    denominator += outside_probs[i][j][binary_rule[0]] * \
-                    inside_probs[i][j][binary_rule[0]] 
-               
+def reestimate(grammar, numerators, denominators):
+    
+    """Computes new binary rule probabilities from expected counts; rules
+       without evidence keep their old probability
+       Input: compiled grammar, numerators and denominators as returned by
+              expected_counts()
+       Output: updated binary rule probabilities, in grammar order
+    """
+    start = time.perf_counter()
+    updated_probs = []
+    for k, binary_rule in enumerate(grammar.binary):
         try:
-            new_prob = numerator / denominator
+            new_prob = numerators[k] / denominators[binary_rule[0]]
         except ZeroDivisionError:
             new_prob =  0.0
+            grammar.fallback_rules += 1
         
         if new_prob == 0.0:
-            new_prob = binary_rule[-1]
-        updated_rules.append((binary_rule[0], binary_rule[1], binary_rule[2],\
-        new_prob))
+            new_prob = grammar.binary_probs[k]
+        updated_probs.append(new_prob)
         
-    return updated_rules
+    grammar.reestimate_time += time.perf_counter() - start
+    return updated_probs
+
+def train_iterate(words, grammar):
+    
+    """Performs a training iteration based on inside-outside algorithm
+       Input: sentence as list of words, compiled grammar
+       Output: updated binary rule probabilities, in grammar order
+    """
+    numerators, denominators = expected_counts(words, grammar)
+    return reestimate(grammar, numerators, denominators)
+    
+def viterbi(words, grammar):
+    
+    """ Finds the most probable parse of a sentence with max-product CKY.
+        The chart is filled by fill_cell() as in inside(), keeping the best
+        way of building each entry and a backpointer to the rule and split
+        point it came from.
+        Input: sentence as list of words, compiled grammar
+        Output: best parse as a bracketed string and its log probability,
+                or (None, None) if the sentence has no parse
+    """
+    n = len(words)
+    if n == 0:
+        return None, None
+    # fill main diagonal with unary rule probabilities
+    best_probs, scales = lexical_chart(words, grammar)
+    backpointers = empty_chart(n)
+    
+    # fill diagonals starting from main diagonal, going towards upper
+    # right-hand corner, keeping the best way of building each entry
+    for j in range(1, n):
+        for i in range(0, n - j):
+            fill_cell(best_probs, scales, i, i + j, grammar, \
+            backpointers[i][i + j])
+    
+    root = best_probs[0][n - 1].get(grammar.start, 0.0)
+    if root <= 0.0:
+        return None, None
+    tree = build_tree(words, backpointers, 0, n - 1, grammar.start, grammar)
+    return tree, math.log(root) + scales[0][n - 1]
+
+def build_tree(words, backpointers, i, j, nt, grammar):
+    
+    """ Builds the bracketed parse of an entry of the Viterbi chart.
+        Input: sentence as list of words, backpointer chart, span, 
+               nonterminal id, compiled grammar
+        Output: bracketed tree, e. g. (S (NP astronomers) (VP ...))
+    """
+    if i == j:
+        return '(' + grammar.symbols[nt] + ' ' + str(words[i]) + ')'
+    k, d = backpointers[i][j][nt]
+    nt_left, nt_right = grammar.binary[k][1], grammar.binary[k][2]
+    return '(' + grammar.symbols[nt] + ' ' + build_tree(words, backpointers, \
+    i, d, nt_left, grammar) + ' ' + build_tree(words, backpointers, d + 1, j, \
+    nt_right, grammar) + ')'
+    
+class DenseGrammar(object):
+    
+    """ Dense tensor view of a compiled grammar for the 'numpy' engine.
+        Input: compiled grammar
+        rules[A, B, C] holds the probability of A -> B C, lexicon[A, v]
+        the probability of A -> vocab[v]; the two extra columns of lexicon
+        stand for unknown words and (all zeros) for padding.
+    """
+    
+    def __init__(self, grammar):
+        n_symbols = len(grammar.symbols)
+        self.grammar = grammar
+        self.start = grammar.start
+        
+        self.vocab = {}
+        self.lexicon = np.zeros((n_symbols, len(grammar.lexicon) + 2))
+        for word, rules in grammar.lexicon.items():
+            self.vocab[word] = len(self.vocab)
+            for nt, prob in rules:
+                self.lexicon[nt, self.vocab[word]] = prob
+        for nt, prob in grammar.unknown:
+            self.lexicon[nt, len(self.vocab)] = prob
+        
+        binary = np.array(grammar.binary, dtype=np.intp).reshape(-1, 3)
+        self.parents, self.lefts, self.rights = binary.T
+        self.rules = np.zeros((n_symbols, n_symbols, n_symbols))
+        self.set_probs(grammar.binary_probs)
+    
+    def set_probs(self, probs):
+        """ Loads binary rule probabilities (in grammar order) into the rule
+            tensor; duplicate rules add up, as in the python engine."""
+        self.probs = np.asarray(probs, dtype=float)
+        self.rules[:] = 0.0
+        np.add.at(self.rules, (self.parents, self.lefts, self.rights), \
+        self.probs)
+    
+    def encode(self, batch):
+        """ Encodes a batch of sentences as a [b, n] array of lexicon
+            columns, with unknown words and padding mapped to their
+            columns."""
+        n = max(len(words) for words in batch)
+        unknown, padding = len(self.vocab), len(self.vocab) + 1
+        ids = np.full((len(batch), n), padding, dtype=np.intp)
+        for s, words in enumerate(batch):
+            for i, word in enumerate(words):
+                column = self.vocab.get(word)
+                if column is None:
+                    self.grammar.unknown_word(word)
+                    column = unknown
+                ids[s, i] = column
+        return ids
+
+def span_children(chart, width):
+    
+    """ Gathers the child cells of every span of a given width.
+        Input: [b, n, n, |N|] charts, span width (j - i)
+        Output: left and right child arrays of shape
+                [b, n - width, width, |N|]
+    """
+    n = chart.shape[1]
+    starts = np.arange(0, n - width)[:, None]
+    splits = starts + np.arange(0, width)[None, :]
+    return chart[:, starts, splits], chart[:, splits + 1, starts + width]
+
+def normalize_cells(cells):
+    
+    """ Rescales chart cells in place so that the largest entry of each is
+        1.0; empty cells get a log scale of 0.
+        Input: [..., |N|] array
+        Output: [...] array of log scales
+    """
+    top = cells.max(axis=-1)
+    nonempty = top > 0
+    cells[nonempty] /= top[nonempty][:, None]
+    return np.where(nonempty, np.log(np.where(nonempty, top, 1.0)), 0.0)
+
+def prune_cells(cells, threshold, beam, exempt):
+    
+    """ Vectorized counterpart of prune_cell() for normalized cells.
+        Input: [..., |N|] array of cells (pruned in place), threshold, beam
+               width or None, [...] boolean array of cells not to prune
+        Output: number of pruned nonempty cells and the sum of the
+                fractions of their mass that were removed
+    """
+    total = cells.sum(axis=-1)
+    keep = cells >= threshold
+    if beam is not None and beam < cells.shape[-1]:
+        floor = -np.partition(-cells, beam - 1, axis=-1)[..., beam - 1]
+        keep &= cells >= floor[..., None]
+    keep |= exempt[..., None]
+    cells *= keep
+    
+    pruned = (total > 0) & ~exempt
+    removed = 1.0 - cells.sum(axis=-1)[pruned] / total[pruned]
+    return int(pruned.sum()), float(removed.sum())
+
+def split_factors(inside_probs, scales, width, top=None):
+    
+    """ Computes the scale factor of every split of the spans of a given
+        width: exp(left scale + right scale - top), or 0 where a child cell
+        is empty. If top is not given, the largest split of each span is
+        used.
+        Input: [b, n, n, |N|] inside array, [b, n, n] log scales, span
+               width, optional [b, n - width] log scales
+        Output: [b, n - width, width] factors and the top log scales
+    """
+    left, right = span_children(inside_probs, width)
+    left_scales, right_scales = span_children(scales[..., None], width)
+    split_scales = left_scales[..., 0] + right_scales[..., 0]
+    valid = (left.max(axis=-1) > 0) & (right.max(axis=-1) > 0)
+    if top is None:
+        top = np.where(valid, split_scales, -np.inf).max(axis=-1)
+        top = np.where(np.isfinite(top), top, 0.0)
+    log_factors = np.minimum(split_scales - top[..., None], MAX_LOG_SCALE)
+    factors = np.where(valid, np.exp(np.where(valid, log_factors, 0.0)), 0.0)
+    return factors, top
+
+def inside_dense(batch, dense):
+    
+    """ Calculates inside probabilities of a batch of sentences with dense
+        NumPy arrays, scaled and pruned per cell as in inside(). Shorter
+        sentences are padded with a word that has no preterminal, so spans
+        reaching into the padding stay zero.
+        Input: list of sentences as lists of words, dense grammar
+        Output: [b, n, n, |N|] array of scaled inside probabilities, n being
+                the length of the longest sentence, and [b, n, n] array of
+                log scales
+    """
+    ids = dense.encode(batch)
+    b, n = ids.shape
+    n_symbols = dense.rules.shape[0]
+    inside_probs = np.zeros((b, n, n, n_symbols))
+    scales = np.zeros((b, n, n))
+    rules = dense.rules.reshape(n_symbols, -1)
+    grammar = dense.grammar
+    lengths = np.array([len(words) for words in batch])
+    
+    # fill main diagonal with unary rule probabilities
+    diagonal = np.arange(0, n)
+    cells = dense.lexicon.T[ids]
+    scales[:, diagonal, diagonal] = normalize_cells(cells)
+    inside_probs[:, diagonal, diagonal] = cells
+    
+    # every span of a diagonal at once, summing child pairs over splits
+    for j in range(1, n):
+        left, right = span_children(inside_probs, j)
+        factors, top = split_factors(inside_probs, scales, j)
+        pairs = np.matmul((left * factors[..., None]).transpose(0, 1, 3, 2), \
+        right)
+        starts = np.arange(0, n - j)
+        cells = pairs.reshape(b, n - j, -1).dot(rules.T)
+        scales[:, starts, starts + j] = top + normalize_cells(cells)
+        if grammar.pruning:
+            # the whole sentence is never pruned
+            roots = (starts[None, :] == 0) & (lengths[:, None] == j + 1)
+            pruned_cells, discarded_mass = prune_cells(cells, \
+            grammar.prune_threshold, grammar.beam, roots)
+            grammar.pruned_cells += pruned_cells
+            grammar.discarded_mass += discarded_mass
+        inside_probs[:, starts, starts + j] = cells
+    
+    return inside_probs, scales
+
+def outside_dense(batch, inside_probs, scales, dense, counts=None):
+    
+    """ Calculates outside probabilities of a batch of sentences with dense
+        NumPy arrays, relative to the sentence probability and the inside
+        scales as in outside(). If a [|N|, |N| * |N|] counts array is given,
+        the expected uses of every (A, B, C) child pair are added to it in
+        the same pass (without the rule probability).
+        Input: list of sentences as lists of words, scaled inside array and
+               log scales, dense grammar, optional counts array
+        Output: [b, n, n, |N|] array of scaled outside probabilities
+    """
+    b, n, n_symbols = inside_probs.shape[0], inside_probs.shape[1], \
+    inside_probs.shape[3]
+    outside_probs = np.zeros(inside_probs.shape)
+    rules = dense.rules.reshape(n_symbols, -1)
+    
+    # default upper right-hand corner rule of each sentence
+    sents, lengths = np.arange(0, b), np.array([len(words) for words in batch])
+    root = inside_probs[sents, 0, lengths - 1, dense.start]
+    parsed = root > 0
+    outside_probs[sents[parsed], 0, lengths[parsed] - 1, dense.start] = \
+    1.0 / root[parsed]
+    
+    # push outside mass of each diagonal down to the children of its spans
+    for j in range(n - 1, 0, -1):
+        starts = np.arange(0, n - j)
+        # only items with inside mass pass outside mass on, as in outside()
+        parents = outside_probs[:, starts, starts + j] * \
+        (inside_probs[:, starts, starts + j] > 0)
+        weighted = parents.dot(rules).reshape(b, n - j, n_symbols, n_symbols)
+        left, right = span_children(inside_probs, j)
+        factors = split_factors(inside_probs, scales, j, \
+        scales[:, starts, starts + j])[0][..., None]
+        left = left * factors
+        splits = starts[:, None] + np.arange(0, j)[None, :]
+        outside_probs[:, starts[:, None], splits] += \
+        np.matmul(right * factors, weighted.transpose(0, 1, 3, 2))
+        outside_probs[:, splits + 1, starts[:, None] + j] += \
+        np.matmul(left, weighted)
+        if counts is not None:
+            pairs = np.matmul(left.transpose(0, 1, 3, 2), right)
+            counts += parents.reshape(-1, n_symbols).T.dot( \
+            pairs.reshape(b * (n - j), -1))
+    
+    return outside_probs
+
+def expected_counts_dense(batch, dense):
+    
+    """Computes the expected rule counts of a batch with dense NumPy arrays,
+       normalized by the sentence probabilities as in expected_counts(); the
+       log probabilities of the sentences are added up as well.
+       Input: list of sentences as lists of words, dense grammar
+       Output: numerators (in grammar order) and denominators (by id)
+    """
+    n_symbols = dense.rules.shape[0]
+    counts = np.zeros((n_symbols, n_symbols * n_symbols))
+    grammar = dense.grammar
+    start = time.perf_counter()
+    inside_probs, scales = inside_dense(batch, dense)
+    middle = time.perf_counter()
+    outside_probs = outside_dense(batch, inside_probs, scales, dense, counts)
+    grammar.inside_time += middle - start
+    grammar.outside_time += time.perf_counter() - middle
+    grammar.sentences += len(batch)
+    grammar.chart_items += int(np.count_nonzero(inside_probs))
+    
+    # log probabilities of the sentences from their root cells
+    sents, ends = np.arange(0, len(batch)), np.array([len(words) - 1 for \
+    words in batch])
+    roots = inside_probs[sents, 0, ends, dense.start]
+    parsed = roots > 0
+    grammar.log_likelihood += float((np.log(roots[parsed]) + \
+    scales[sents, 0, ends][parsed]).sum())
+    grammar.parsed_sentences += int(parsed.sum())
+    counts = counts.reshape(n_symbols, n_symbols, n_symbols)
+    
+    numerators = dense.probs * \
+    counts[dense.parents, dense.lefts, dense.rights]
+    denominators = (outside_probs * inside_probs).sum(axis=(0, 1, 2))
+    return numerators, denominators
+
+def reestimate_dense(dense, numerators, denominators):
+    
+    """Vectorized counterpart of reestimate()
+       Input: dense grammar, numerators and denominators arrays
+       Output: updated binary rule probabilities, in grammar order
+    """
+    start = time.perf_counter()
+    denominators = denominators[dense.parents]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        new_probs = np.where(denominators > 0, numerators / denominators, \
+        0.0)
+    new_probs = np.where(new_probs == 0.0, dense.probs, new_probs)
+    
+    dense.grammar.fallback_rules += int(np.count_nonzero(denominators == 0))
+    dense.grammar.reestimate_time += time.perf_counter() - start
+    return new_probs.tolist()
+
+class Corpus(object):
+    
+    """ Streaming training corpus. Sentences are read lazily, one line at a
+        time, every time the corpus is iterated over, so memory use does
+        not depend on the size of the corpus.
+        Input: path of a text file, or of a directory whose files (in
+        sorted order) are the shards of the corpus
+        Iterating yields sentences as lists of words; empty lines are
+        skipped.
+    """
+    
+    def __init__(self, path):
+        if os.path.isdir(path):
+            self.files = [os.path.join(path, name) for name in \
+            sorted(os.listdir(path)) if os.path.isfile(os.path.join(path, \
+            name))]
+        elif os.path.isfile(path):
+            self.files = [path]
+        else:
+            print("Could not find file '" + path + "'")
+            sys.exit(-1)
+    
+    def __iter__(self):
+        for name in self.files:
+            with open(name) as f:
+                for line in f:
+                    words = line.split()
+                    if words:
+                        yield words
+    
+    def shards(self, count):
+        """ Splits the corpus into at most count parts for worker
+            processes: whole files, balanced by size, if there are at least
+            count of them, otherwise byte ranges of equal size.
+            Output: list of CorpusShard"""
+        sizes = dict((name, os.path.getsize(name)) for name in self.files)
+        if len(self.files) >= count:
+            parts, loads = [[] for k in range(0, count)], [0] * count
+            for name in sorted(self.files, key=sizes.get, reverse=True):
+                k = loads.index(min(loads))
+                parts[k].append(name)
+                loads[k] += sizes[name]
+            return [CorpusShard([(name, 0, sizes[name]) for name in \
+            self.files if name in part]) for part in parts if part]
+        
+        total = sum(sizes.values())
+        bounds = [total * k // count for k in range(0, count + 1)]
+        shards = []
+        for k in range(0, count):
+            ranges, offset = [], 0
+            for name in self.files:
+                start = max(bounds[k] - offset, 0)
+                end = min(bounds[k + 1] - offset, sizes[name])
+                if start < end:
+                    ranges.append((name, start, end))
+                offset += sizes[name]
+            if ranges:
+                shards.append(CorpusShard(ranges))
+        return shards
+
+class CorpusShard(object):
+    
+    """ Part of a text corpus read by one worker process.
+        Input: list of (path, start, end) byte ranges of corpus files; a
+        line belongs to the range its first byte is in
+        Iterating yields sentences as lists of words, as Corpus does.
+    """
+    
+    def __init__(self, ranges):
+        self.ranges = ranges
+    
+    def __iter__(self):
+        encoding = locale.getpreferredencoding(False)
+        for name, start, end in self.ranges:
+            with open(name, 'rb') as f:
+                # skip the line that started in the previous range
+                if start > 0:
+                    f.seek(start - 1)
+                    f.readline()
+                while f.tell() < end:
+                    line = f.readline()
+                    if not line:
+                        break
+                    words = line.decode(encoding).split()
+                    if words:
+                        yield words
+
+# binary corpus layout: header (magic, number of tokens, number of
+# sentences, size of the vocabulary in bytes), int32 token ids, int64
+# sentence offsets into the tokens, newline-separated utf-8 vocabulary;
+# sections start at multiples of 8 bytes, numbers are little-endian
+CORPUS_MAGIC = b'IOCORP01'
+CORPUS_HEADER = struct.Struct('<8sQQQ')
+
+def aligned(position):
+    
+    """ Rounds a file position up to a multiple of 8 bytes."""
+    return (position + 7) // 8 * 8
+
+# sizes in bytes of the array type codes used by the binary formats
+ITEM_SIZES = {'i': 4, 'q': 8, 'd': 8}
+
+def check_item_size(typecode):
+    
+    """ Exits if an array type code has another size on this machine than
+        in the binary formats."""
+    if array.array(typecode).itemsize != ITEM_SIZES[typecode]:
+        print("Binary files need " + str(ITEM_SIZES[typecode]) + "-byte '" + \
+        typecode + "' arrays, which this machine does not have")
+        sys.exit(-1)
+
+def write_array(o, typecode, values):
+    
+    """ Writes numbers to a binary file as a little-endian array.
+        Input: open file, array type code (see ITEM_SIZES), numbers
+        Output: ---
+    """
+    check_item_size(typecode)
+    values = array.array(typecode, values)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    values.tofile(o)
+
+def read_array(view, typecode):
+    
+    """ Reads a little-endian array written by write_array(). On
+        little-endian machines the memoryview is cast without copying.
+        Input: memoryview of the bytes of the array, array type code
+        Output: sequence of numbers
+    """
+    check_item_size(typecode)
+    if sys.byteorder == 'little':
+        return view.cast(typecode)
+    values = array.array(typecode, bytes(view))
+    values.byteswap()
+    return values
+
+def encode_corpus(source, target):
+    
+    """ Converts a text corpus into the pre-tokenized binary format read by
+        EncodedCorpus. Tokens are streamed to the target file, so the corpus
+        is never held in memory.
+        Input: path of the text corpus (file or directory), path of the
+               binary corpus to write
+        Output: number of sentences written
+    """
+    vocab = {}
+    n_tokens, n_sents = 0, 0
+    with open(target, 'wb') as o, tempfile.TemporaryFile() as offsets:
+        o.write(CORPUS_HEADER.pack(CORPUS_MAGIC, 0, 0, 0))
+        write_array(offsets, 'q', [0])
+        for words in Corpus(source):
+            tokens = [vocab.setdefault(word, len(vocab)) for word in words]
+            write_array(o, 'i', tokens)
+            n_tokens += len(tokens)
+            n_sents += 1
+            write_array(offsets, 'q', [n_tokens])
+        
+        o.write(b'\0' * (aligned(o.tell()) - o.tell()))
+        offsets.seek(0)
+        shutil.copyfileobj(offsets, o)
+        words = sorted(vocab, key=vocab.get)
+        vocab_bytes = '\n'.join(words).encode('utf-8')
+        o.write(vocab_bytes)
+        o.seek(0)
+        o.write(CORPUS_HEADER.pack(CORPUS_MAGIC, n_tokens, n_sents, \
+        len(vocab_bytes)))
+        
+    return n_sents
+
+class EncodedCorpus(object):
+    
+    """ Pre-tokenized corpus written by encode_corpus(), memory-mapped.
+        Input: path of the binary corpus; optionally the range of sentences
+        to read (first, up to last), for the shards of worker processes
+        Iterating yields sentences as sequences of integer token ids
+        (views into the mapped file on little-endian machines); vocab[id]
+        is the word of a token id.
+    """
+    
+    def __init__(self, path, first=0, last=None):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, n_tokens, n_sents, n_vocab = \
+        CORPUS_HEADER.unpack_from(self.map)
+        if magic != CORPUS_MAGIC:
+            print("'" + path + "' is not an encoded corpus")
+            sys.exit(-1)
+        
+        view = memoryview(self.map)
+        position = CORPUS_HEADER.size
+        self.tokens = read_array(view[position:position + 4 * n_tokens], 'i')
+        position = aligned(position + 4 * n_tokens)
+        self.offsets = read_array(view[position:position + 8 * (n_sents + \
+        1)], 'q')
+        position += 8 * (n_sents + 1)
+        vocab = bytes(view[position:position + n_vocab]).decode('utf-8')
+        self.vocab = vocab.split('\n') if vocab else []
+        self.first = first
+        self.last = n_sents if last is None else last
+    
+    def __len__(self):
+        return self.last - self.first
+    
+    def __iter__(self):
+        tokens, offsets = self.tokens, self.offsets
+        for s in range(self.first, self.last):
+            yield tokens[offsets[s]:offsets[s + 1]]
+    
+    def shards(self, count):
+        """ Splits the corpus into at most count ranges of sentences for
+            worker processes.
+            Output: list of EncodedCorpus"""
+        bounds = [self.first + len(self) * k // count for k in \
+        range(0, count + 1)]
+        return [EncodedCorpus(self.path, bounds[k], bounds[k + 1]) for k in \
+        range(0, count) if bounds[k] < bounds[k + 1]]
+    
+    def __getstate__(self):
+        # worker processes map the file themselves
+        return {'path': self.path, 'first': self.first, 'last': self.last}
+    
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['first'], state['last'])
+
+def open_corpus(path):
+    
+    """ Opens a training corpus, encoded or plain text.
+        Input: path of a binary corpus, text file or directory of text files
+        Output: EncodedCorpus or Corpus
+    """
+    if os.path.isfile(path):
+        with open(path, 'rb') as f:
+            if f.read(len(CORPUS_MAGIC)) == CORPUS_MAGIC:
+                return EncodedCorpus(path)
+    return Corpus(path)
+
+def corpus_shards(corpus, count):
+    
+    """ Splits a corpus into at most count parts, one per worker process,
+        so that every worker reads only its own sentences.
+        Input: Corpus, EncodedCorpus or list of sentences, number of parts
+        Output: list of corpus parts (lists of sentences for a list)
+    """
+    if hasattr(corpus, 'shards'):
+        return corpus.shards(count)
+    sents = corpus if isinstance(corpus, list) else list(corpus)
+    bounds = [len(sents) * k // count for k in range(0, count + 1)]
+    return [sents[bounds[k]:bounds[k + 1]] for k in range(0, count) if \
+    bounds[k] < bounds[k + 1]]
+
+# number of batches read ahead and sorted together by sentence length
+BUCKET_WINDOW = 64
+
+def sentence_batches(sents, batch_size, window=BUCKET_WINDOW):
+    
+    """Groups sentences of similar length into batches. Sentences are read
+       window * batch_size at a time and sorted by length within that
+       window, so the corpus can be streamed.
+       Input: iterable of sentences as lists of words, batch size, number
+              of batches per window
+       Output: generator of batches, shortest sentences of a window first
+    """
+    sents = iter(sents)
+    while True:
+        chunk = list(itertools.islice(sents, batch_size * window))
+        if not chunk:
+            return
+        chunk.sort(key=len)
+        for b in range(0, len(chunk), batch_size):
+            yield chunk[b:b + batch_size]
+
+def batch_counts(batch, grammar, dense=None):
+    
+    """Runs inside and outside on a batch of sentences against a fixed
+       grammar and adds up their expected rule counts.
+       Input: list of sentences as lists of words, compiled grammar, dense
+              grammar when the 'numpy' engine is used
+       Output: numerators and denominators (see expected_counts())
+    """
+    if dense is None:
+        numerators, denominators = None, None
+        for words in batch:
+            numerators, denominators = expected_counts(words, grammar, \
+            numerators, denominators)
+        return numerators, denominators
+    
+    return expected_counts_dense(batch, dense)
+
+def train_batch(batch, grammar, dense=None):
+    
+    """Runs inside, outside and the rule update on a batch of sentences;
+       the grammar is fixed within the batch and the expected counts of its
+       sentences are added up before re-estimation.
+       Input: list of sentences as lists of words, compiled grammar, dense
+              grammar when the 'numpy' engine is used
+       Output: updated binary rule probabilities, in grammar order
+    """
+    if dense is None:
+        numerators, denominators = batch_counts(batch, grammar)
+        return reestimate(grammar, numerators, denominators)
+    
+    dense.set_probs(grammar.binary_probs)
+    numerators, denominators = batch_counts(batch, grammar, dense)
+    return reestimate_dense(dense, numerators, denominators)
+
+class OnlineEM(object):
+    
+    """ Stepwise online EM (Liang and Klein, 2009). Running sufficient
+        statistics (expected rule and nonterminal counts) are kept between
+        mini-batches: after the k-th mini-batch (counting from 0) they are
+        replaced by (1 - eta) * statistics + eta * counts of the mini-batch,
+        with step size eta = (k + step_offset) ** -step_power, and the rule
+        probabilities are re-estimated from them. A power between 0.5 and 1
+        guarantees convergence; smaller powers forget old data faster.
+        Input: compiled grammar (its probabilities are updated in place),
+        step size offset (at least 1) and power, engine ('python' or
+        'numpy'), statistics to continue from (see statistics())
+    """
+    
+    def __init__(self, grammar, step_offset=2.0, step_power=0.7, \
+    engine='python', statistics=None):
+        if step_offset < 1.0:
+            print("Step size offset must be at least 1")
+            sys.exit(-1)
+        if not 0.5 < step_power <= 1.0:
+            print("Step size power must be greater than 0.5 and at most 1")
+            sys.exit(-1)
+        self.grammar = grammar
+        self.step_offset = step_offset
+        self.step_power = step_power
+        self.dense = DenseGrammar(grammar) if engine == 'numpy' else None
+        if statistics is None:
+            statistics = ([0.0] * len(grammar.binary), [0.0] * \
+            len(grammar.symbols), 0)
+        self.numerators, self.denominators, self.updates = statistics
+        if self.dense is not None:
+            self.numerators = np.asarray(self.numerators, dtype=float)
+            self.denominators = np.asarray(self.denominators, dtype=float)
     
+    def step_size(self):
+        
+        """Step size of the next update."""
+        return (self.updates + self.step_offset) ** -self.step_power
+    
+    def update(self, batch):
+        
+        """Updates the statistics and the grammar with a mini-batch.
+           Input: list of sentences as lists of words
+           Output: updated binary rule probabilities, in grammar order"""
+        eta = self.step_size()
+        if self.dense is None:
+            numerators, denominators = batch_counts(batch, self.grammar)
+            self.numerators = [(1.0 - eta) * old + eta * new for old, new in \
+            zip(self.numerators, numerators)]
+            self.denominators = [(1.0 - eta) * old + eta * new for old, new \
+            in zip(self.denominators, denominators)]
+            probs = reestimate(self.grammar, self.numerators, \
+            self.denominators)
+        else:
+            self.dense.set_probs(self.grammar.binary_probs)
+            numerators, denominators = batch_counts(batch, self.grammar, \
+            self.dense)
+            self.numerators = (1.0 - eta) * self.numerators + eta * numerators
+            self.denominators = (1.0 - eta) * self.denominators + eta * \
+            denominators
+            probs = reestimate_dense(self.dense, self.numerators, \
+            self.denominators)
+        
+        self.updates += 1
+        self.grammar.binary_probs = probs
+        return probs
+    
+    def statistics(self):
+        
+        """Sufficient statistics to continue from: numerators (in grammar
+           order) and denominators (by nonterminal id) as lists, and the
+           number of updates made."""
+        return list(self.numerators), list(self.denominators), self.updates
+
+# grammar, dense grammar and batch size of a worker process, set once per
+# iteration by init_worker()
+worker_state = None
+
+def init_worker(grammar, engine, batch_size):
+    
+    """Initializes a worker process with a frozen copy of the grammar.
+       Input: compiled grammar, engine name, batch size (or None)
+       Output: ---"""
+    
+    global worker_state
+    dense = DenseGrammar(grammar) if engine == 'numpy' else None
+    worker_state = (grammar, dense, batch_size)
+
+def shard_counts(shard):
+    
+    """Computes the expected rule counts of a shard of the corpus in a
+       worker process; only the sentences of the shard are read.
+       Input: part of the corpus as returned by corpus_shards()
+       Output: numerators and denominators as lists, training counters of
+               the shard (see Grammar.stats())"""
+       
+    grammar, dense, batch_size = worker_state
+    stats = grammar.stats()
+    numerators = [0.0] * len(grammar.binary)
+    denominators = [0.0] * len(grammar.symbols)
+    for batch in sentence_batches(shard, batch_size or 1):
+        batch_numerators, batch_denominators = batch_counts(batch, grammar, \
+        dense)
+        for rule in range(0, len(numerators)):
+            numerators[rule] += batch_numerators[rule]
+        for nt in range(0, len(denominators)):
+            denominators[nt] += batch_denominators[nt]
+    return numerators, denominators, dict((name, value - stats[name]) for \
+    name, value in grammar.stats().items())
+
+def parallel_pass(corpus, grammar, engine, batch_size, workers):
+    
+    """Performs one batch EM pass over the corpus in worker processes. Each
+       worker receives the grammar once and returns the expected counts of
+       its shard; the rules are re-estimated once from the summed counts,
+       which gives the same update as one batch of the whole corpus.
+       Input: corpus (see corpus_shards()), compiled grammar, engine name,
+              batch size within a worker, number of workers
+       Output: updated binary rule probabilities, in grammar order
+    """
+    shards = corpus_shards(corpus, workers)
+    numerators = [0.0] * len(grammar.binary)
+    denominators = [0.0] * len(grammar.symbols)
+    
+    pool = multiprocessing.Pool(workers, init_worker, (grammar, engine, \
+    batch_size))
+    try:
+        for shard_numerators, shard_denominators, stats in \
+        pool.imap(shard_counts, shards):
+            grammar.add_stats(stats)
+            for k in range(0, len(numerators)):
+                numerators[k] += shard_numerators[k]
+            for nt in range(0, len(denominators)):
+                denominators[nt] += shard_denominators[nt]
+    finally:
+        pool.close()
+        pool.join()
+    
+    return reestimate(grammar, numerators, denominators)
+    
+def parse_sentence(words):
+    
+    """Parses a sentence in a worker process initialized by init_worker().
+       Input: sentence as list of words
+       Output: bracketed tree and log probability (see viterbi())"""
+       
+    return viterbi(words, worker_state[0])
+
+def parse_sentences(sents, grammar, workers=None, chunk_size=64):
+    
+    """Parses a stream of sentences with the Viterbi algorithm, in worker
+       processes if requested. Each worker receives the grammar once, and
+       sentences are read ahead only a few chunks at a time.
+       Input: iterable of sentences as lists of words, compiled grammar,
+              number of workers (or None), sentences per task
+       Output: generator of (bracketed tree, log probability) pairs in input
+               order; both are None for sentences without a parse
+    """
+    if workers is None:
+        for words in sents:
+            yield viterbi(words, grammar)
+        return
+    
+    sents = iter(sents)
+    pool = multiprocessing.Pool(workers, init_worker, (grammar, 'python', \
+    None))
+    try:
+        while True:
+            window = list(itertools.islice(sents, workers * chunk_size * 4))
+            if not window:
+                break
+            for result in pool.imap(parse_sentence, window, chunk_size):
+                yield result
+    finally:
+        pool.close()
+        pool.join()
+
 def check_improvement(old_rules, new_rules):
     
-    """Check changes between old and new set of rules.
+    """Check changes between old and new set of rules. Rules are matched by
+       their symbols, so the two sets need not be in the same order; a rule
+       missing from one of them counts as having probability 0 there.
        Input: two sets of binary rules
        Output: max difference between old and new probabilities"""
     
     max_improvement = 0
+    old_probs = dict((rule[:-1], rule[-1]) for rule in old_rules)
 
-    for i in range(0, len(old_rules)):
-        if abs(old_rules[i][-1] - new_rules[i][-1]) > max_improvement:
-            max_improvement = abs(old_rules[i][-1] - new_rules[i][-1])
+    for rule in new_rules:
+        improvement = abs(old_probs.pop(rule[:-1], 0.0) - rule[-1])
+        if improvement > max_improvement:
+            max_improvement = improvement
+    for prob in old_probs.values():
+        if abs(prob) > max_improvement:
+            max_improvement = abs(prob)
     
     return max_improvement
+
+def relative_gain(history):
+    
+    """Relative log-likelihood gain of the last iteration.
+       Input: list of (max improvement, log-likelihood) of the iterations
+       Output: gain of the last log-likelihood over the previous one, in
+               units of the previous one's absolute value; None before the
+               second iteration"""
+       
+    if len(history) < 2:
+        return None
+    old, new = history[-2][1], history[-1][1]
+    if old == 0.0:
+        return 0.0 if new == 0.0 else float('inf')
+    return (new - old) / abs(old)
+
+def has_converged(history, convergence, threshold):
+    
+    """Decides whether training has converged: the log-likelihood of the
+       last iteration changed by less than the threshold (relative_gain()
+       in either direction; the log-likelihood can drop, e. g. right after
+       an unnormalized initial grammar, and training goes on after a large
+       drop) or the largest change of a rule probability is below it.
+       Input: list of (max improvement, log-likelihood) of the iterations,
+              'likelihood' or 'rules', threshold
+       Output: boolean"""
+    
+    if not history:
+        return False
+    if convergence == 'rules':
+        return history[-1][0] < threshold
+    gain = relative_gain(history)
+    return gain is not None and abs(gain) < threshold
     
 def print_rules(u_rules, b_rules, output_file):
     
@@ -237,102 +1344,595 @@ def print_rules(u_rules, b_rules, output_file):
     Input: unary and binary rules, output filename
     Output: ---"""
     
-    # empty file    
-    with open(output_file, 'w'):
-        pass
-    
     unary_rules, binary_rules = u_rules, b_rules
+    lines = []
     
     #sort and print binary rules
     #binary_rules.sort(key=lambda x: x[-1])
     for binary_rule in binary_rules:
         if binary_rule[-1] >= 0.0:
-            with open(output_file, 'a+') as o:
-                o.write(' '.join([binary_rule[0], '->', binary_rule[1], \
-                binary_rule[2], str(binary_rule[3]), '\n']))
+            lines.append(' '.join([binary_rule[0], '->', binary_rule[1], \
+            binary_rule[2], str(binary_rule[3]), '\n']))
             
     # print unary rules
     for unary_rule in unary_rules:
         if unary_rule[-1] >= 0.0:
-            with open(output_file, 'a+') as o:
-                o.write(' '.join([unary_rule[0], '->', str("'" + unary_rule[1] + "'"), \
-                str(unary_rule[2]), '\n']))
+            lines.append(' '.join([unary_rule[0], '->', \
+            str("'" + unary_rule[1] + "'"), str(unary_rule[2]), '\n']))
+    
+    # write the whole file at once
+    with open(output_file, 'w') as o:
+        o.writelines(lines)
+
+# binary grammar layout: header (magic, number of nonterminals, number of
+# terminals, number of unary and binary rules, size of the symbol table in
+# bytes), newline-separated utf-8 symbol table (nonterminals, then
+# terminals), int32 nonterminal and terminal ids of the unary rules, int32
+# nonterminal ids of the binary rules, float64 probabilities of the unary
+# and binary rules; sections start at multiples of 8 bytes, numbers are
+# little-endian (see write_array())
+GRAMMAR_MAGIC = b'IOGRAM01'
+GRAMMAR_HEADER = struct.Struct('<8sQQQQQ')
+GRAMMAR_FORMATS = ('text', 'binary')
+
+# how training() decides that it has converged
+CONVERGENCE_CRITERIA = ('likelihood', 'rules')
+
+def write_grammar(u_rules, b_rules, nts, output_file):
+    
+    """Writes rules in the binary grammar format read by load_grammar().
+    Input: unary and binary rules, nonterminals, output filename
+    Output: ---"""
+    
+    nt_ids = dict((nt, k) for k, nt in enumerate(nts))
+    word_ids = {}
+    unary_ids = array.array('i')
+    for nt, word, prob in u_rules:
+        unary_ids.append(nt_ids.setdefault(nt, len(nt_ids)))
+        unary_ids.append(word_ids.setdefault(word, len(word_ids)))
+    binary_ids = array.array('i')
+    for rule in b_rules:
+        for nt in rule[:3]:
+            binary_ids.append(nt_ids.setdefault(nt, len(nt_ids)))
+    probs = array.array('d', [rule[-1] for rule in u_rules])
+    probs.extend(rule[-1] for rule in b_rules)
+    
+    names = sorted(nt_ids, key=nt_ids.get) + sorted(word_ids, \
+    key=word_ids.get)
+    names_bytes = '\n'.join(names).encode('utf-8')
+    with open(output_file, 'wb') as o:
+        o.write(GRAMMAR_HEADER.pack(GRAMMAR_MAGIC, len(nt_ids), \
+        len(word_ids), len(u_rules), len(b_rules), len(names_bytes)))
+        o.write(names_bytes)
+        o.write(b'\0' * (aligned(o.tell()) - o.tell()))
+        write_array(o, 'i', unary_ids)
+        write_array(o, 'i', binary_ids)
+        o.write(b'\0' * (aligned(o.tell()) - o.tell()))
+        write_array(o, 'd', probs)
+
+def load_grammar(path):
+    
+    """Reads rules written by write_grammar().
+    Input: path of the binary grammar
+    Output: unary and binary rules, nonterminals"""
+    
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, n_nts, n_words, n_unary, n_binary, n_names = \
+    GRAMMAR_HEADER.unpack_from(data)
+    if magic != GRAMMAR_MAGIC:
+        print("'" + path + "' is not a binary grammar")
+        sys.exit(-1)
+    
+    view = memoryview(data)
+    position = GRAMMAR_HEADER.size
+    names = bytes(view[position:position + n_names]).decode('utf-8')
+    names = names.split('\n') if n_nts + n_words else []
+    nts, words = names[:n_nts], names[n_nts:]
+    position = aligned(position + n_names)
+    unary_ids = read_array(view[position:position + 8 * n_unary], 'i')
+    position += 8 * n_unary
+    binary_ids = read_array(view[position:position + 12 * n_binary], 'i')
+    position = aligned(position + 12 * n_binary)
+    probs = read_array(view[position:position + 8 * (n_unary + n_binary)], \
+    'd')
+    
+    unary_rules = [(nts[unary_ids[2 * k]], words[unary_ids[2 * k + 1]], \
+    probs[k]) for k in range(0, n_unary)]
+    binary_rules = [(nts[binary_ids[3 * k]], nts[binary_ids[3 * k + 1]], \
+    nts[binary_ids[3 * k + 2]], probs[n_unary + k]) for k in \
+    range(0, n_binary)]
+    
+    return unary_rules, binary_rules, nts
+
+def save_rules(u_rules, b_rules, nts, output_file, grammar_format='text'):
+    
+    """Writes rules as text (print_rules()) or in the binary format
+    (write_grammar()).
+    Input: unary and binary rules, nonterminals, output filename, format
+    Output: ---"""
+    
+    if grammar_format == 'binary':
+        write_grammar(u_rules, b_rules, nts, output_file)
+    else:
+        print_rules(u_rules, b_rules, output_file)
+    
+def iteration_metrics(i, iterations, grammar, history, elapsed):
+    
+    """Collects the metrics of a training iteration.
+    Input: postfix of output.txt, number of the iteration, grammar trained
+    on in the iteration, list of (max improvement, log-likelihood) of the
+    iterations so far, seconds the iteration took
+    Output: dictionary of metrics: run, iteration, seconds, sentences per
+    second, active binary rules (after zero pruning), chart items per
+    sentence, unparsed sentences, max improvement, relative log-likelihood
+    gain and the training counters of the grammar (see GRAMMAR_STATS; times
+    of worker processes are added up)"""
+    
+    metrics = grammar.stats()
+    sentences = max(grammar.sentences, 1)
+    metrics.update({'run': i, 'iteration': iterations, 'seconds': elapsed, \
+    'sentences_per_sec': grammar.sentences / elapsed if elapsed > 0 else \
+    None, 'binary_rules': len(grammar.binary), 'chart_items_per_sentence': \
+    grammar.chart_items / sentences, 'unparsed_sentences': \
+    grammar.sentences - grammar.parsed_sentences, 'max_improvement': \
+    history[-1][0], 'relative_gain': relative_gain(history)})
+    return metrics
+
+def training_state(i, arguments, unary_rules, binary_rules, nts, grammar, \
+iterations, history, position, elapsed, statistics=None, \
+previous_rules=None):
+    
+    """Collects what resume_training() needs to continue a run.
+    Input: postfix of output.txt, arguments of training(), unary rules,
+    binary rules the current iteration started from (between iterations:
+    the updated ones), nonterminals, partly trained grammar, number of
+    finished iterations, improvement of each iteration, number of batches
+    of the current iteration already trained on and seconds spent on them,
+    statistics of online training (see OnlineEM), binary rules the last
+    finished iteration started from (between iterations), which are the
+    rules written to output_i.txt
+    Output: training state as a dictionary"""
+    
+    return {'i': i, 'arguments': arguments, 'unary_rules': unary_rules, \
+    'binary_rules': binary_rules, 'nts': nts, 'binary_probs': \
+    grammar.binary_probs, 'iterations': iterations, 'history': history, \
+    'position': position, 'stats': grammar.stats(), 'elapsed': elapsed, \
+    'statistics': statistics, 'previous_rules': previous_rules}
+
+def save_checkpoint(path, state):
+    
+    """Writes a training checkpoint atomically: the state is written to a
+    temporary file next to the checkpoint, which then replaces it, so an
+    interrupted write never leaves a damaged checkpoint behind.
+    Input: path of the checkpoint, training state (see training())
+    Output: ---"""
+    
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile(dir=directory, delete=False) as o:
+        pickle.dump(state, o, pickle.HIGHEST_PROTOCOL)
+        o.flush()
+        os.fsync(o.fileno())
+    os.replace(o.name, path)
+
+def load_checkpoint(path):
+    
+    """Reads a checkpoint written by save_checkpoint().
+    Input: path of the checkpoint
+    Output: training state (see training_state())"""
+    
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except IOError:
+        print("Could not find file '" + path + "'")
+        sys.exit(-1)
+    except (pickle.UnpicklingError, EOFError):
+        print("'" + path + "' is not a training checkpoint")
+        sys.exit(-1)
+
+def resume_training(path, **arguments):
+    
+    """Continues a training run from the checkpoint written by training(),
+    with the arguments of the original run.
+    Input: path of the checkpoint; keyword arguments of training() that
+    replace those of the original run (e. g. max_iterations)
+    Output: trained binary rules"""
+    
+    state = load_checkpoint(path)
+    state['arguments'].update(arguments)
+    return training(state['unary_rules'], state['binary_rules'], \
+    state['nts'], state['i'], state=state, **state['arguments'])
+
+def online_update(path, corpus, rules=None, batch_size=32, \
+step_offset=2.0, step_power=0.7, engine='python', unknown_words='ignore'):
+    
+    """Updates a grammar with new sentences by stepwise online EM (see
+    OnlineEM), without going over earlier data again. The grammar and the
+    sufficient statistics are kept in a state file, which is created on the
+    first call and replaced atomically after every call; later calls use
+    the step size settings, engine and unknown word policy stored in it.
+    Input: path of the state file, corpus of new sentences (path or
+    iterable of sentences as lists of words), initial unary and binary rules
+    and nonterminals (used only if the state file does not exist yet),
+    mini-batch size, step size offset and power, engine, unknown word policy
+    Output: updated unary and binary rules and nonterminals"""
+    
+    if os.path.exists(path):
+        state = load_checkpoint(path)
+        unary_rules, binary_rules, nts = state['unary_rules'], \
+        state['binary_rules'], state['nts']
+        step_offset, step_power, engine, unknown_words = \
+        state['step_offset'], state['step_power'], state['engine'], \
+        state['unknown_words']
+        statistics = state['statistics']
+    elif rules is not None:
+        unary_rules, binary_rules, nts = rules
+        statistics = None
+    else:
+        print("Could not find file '" + path + "'")
+        sys.exit(-1)
+    if engine == 'numpy' and np is None:
+        print("The 'numpy' engine requires NumPy to be installed")
+        sys.exit(-1)
+    if batch_size < 1:
+        print("Batch size must be a positive integer")
+        sys.exit(-1)
+    
+    if isinstance(corpus, str):
+        corpus = open_corpus(corpus)
+    grammar = Grammar(unary_rules, binary_rules, nts, getattr(corpus, \
+    'vocab', None), unknown_words)
+    learner = OnlineEM(grammar, step_offset, step_power, engine, statistics)
+    updates = learner.updates
+    for batch in sentence_batches(corpus, batch_size):
+        learner.update(batch)
+    print('Updated with', grammar.sentences, 'sentences in', \
+    learner.updates - updates, 'mini-batches; log-likelihood', \
+    grammar.log_likelihood, 'of', grammar.parsed_sentences, 'sentences')
+    
+    binary_rules = grammar.binary_rules()
+    save_checkpoint(path, {'unary_rules': unary_rules, 'binary_rules': \
+    binary_rules, 'nts': nts, 'statistics': learner.statistics(), \
+    'step_offset': step_offset, 'step_power': step_power, 'engine': engine, \
+    'unknown_words': unknown_words})
+    return unary_rules, binary_rules, nts
+
+def corpus_log_likelihood(corpus, grammar):
+    
+    """Computes the log-likelihood of a corpus under a grammar; sentences
+    without a parse are left out.
+    Input: corpus (iterable of sentences as lists of words), compiled grammar
+    Output: total log probability of the parsed sentences"""
+    
+    log_likelihood = 0.0
+    for words in corpus:
+        inside_probs, scales = inside(words, grammar)
+        log_prob = sentence_log_prob(inside_probs, scales, grammar)
+        if log_prob is not None:
+            log_likelihood += log_prob
+    return log_likelihood
+
+def restart_round(job):
+    
+    """Trains one run of random_restarts() for a round of iterations, in a
+    worker process; the run continues from its checkpoint.
+    Input: run index, path of its checkpoint, number of iterations to stop
+    after, initial unary and binary rules and nonterminals (first round
+    only, otherwise None), arguments of training()
+    Output: run index, number of iterations done, corpus log-likelihood
+    of the grammar written to output_k.txt"""
+    
+    k, path, max_iterations, rules, arguments = job
+    if rules is not None:
+        training(rules[0], rules[1], rules[2], k, checkpoint=path, \
+        log_dir='log_' + str(k), max_iterations=max_iterations, **arguments)
+    else:
+        resume_training(path, max_iterations=max_iterations)
+    
+    state = load_checkpoint(path)
+    arguments = state['arguments']
+    corpus = arguments['corpus']
+    if isinstance(corpus, str):
+        corpus = open_corpus(corpus)
+    grammar = Grammar(state['unary_rules'], state['previous_rules'], \
+    state['nts'], getattr(corpus, 'vocab', None), arguments['unknown_words'], \
+    arguments['prune_threshold'], arguments['beam'])
+    return k, state['iterations'], corpus_log_likelihood(corpus, grammar)
+
+def random_restarts(unary_rules, binary_rules, nts, restarts, noise=0.5, \
+seed=None, workers=None, round_length=5, margin=0.05, **arguments):
     
-def training(unary_rules, binary_rules, nts, i):
+    """Trains several randomly perturbed copies of a grammar in parallel
+    and keeps the best one. Runs advance in rounds of round_length
+    iterations; after every round the corpus log-likelihood of each run is
+    computed, and runs more than margin times the absolute log-likelihood
+    of the best run behind it are stopped. Run k writes log_k/ and
+    output_k.txt; the log-likelihood of a run is that of the grammar in
+    output_k.txt, and the best of these grammars is also written to
+    output_best.txt (.bin for binary grammars).
+    Input: unary and binary rules and nonterminals as returned by
+    read_grammar(), number of runs, noise of perturb_probabilities(),
+    random seed, number of worker processes (default: one per CPU),
+    iterations per round, stopping margin, further arguments of training()
+    (not workers or checkpoint)
+    Output: index of the best run and its trained binary rules"""
+    
+    if restarts < 1:
+        print("Number of restarts must be a positive integer")
+        sys.exit(-1)
+    if round_length < 1:
+        print("Round length must be a positive integer")
+        sys.exit(-1)
+    if margin < 0.0:
+        print("Stopping margin must not be negative")
+        sys.exit(-1)
+    
+    seeds = random.Random(seed).sample(range(0, 2 ** 31), restarts)
+    paths = [os.path.join('log_' + str(k), 'checkpoint') for k in \
+    range(0, restarts)]
+    jobs = [(k, paths[k], round_length, (unary_rules, perturb_probabilities( \
+    binary_rules, noise, seeds[k]), nts), arguments) for k in \
+    range(0, restarts)]
+    log_likelihoods = {}
+    
+    pool = multiprocessing.Pool(workers)
+    try:
+        rounds = 1
+        while jobs:
+            running = []
+            for k, iterations, log_likelihood in pool.imap_unordered( \
+            restart_round, jobs):
+                log_likelihoods[k] = log_likelihood
+                print('Run', k, 'log-likelihood', log_likelihood, 'after', \
+                iterations, 'iterations')
+                # a run that stopped before the end of the round converged
+                if iterations == rounds * round_length:
+                    running.append(k)
+            
+            best = max(log_likelihoods.values())
+            for k in sorted(running):
+                if log_likelihoods[k] < best - margin * abs(best):
+                    running.remove(k)
+                    print('Run', k, 'stopped with log-likelihood', \
+                    log_likelihoods[k], 'after', rounds * round_length, \
+                    'iterations')
+            rounds += 1
+            jobs = [(k, paths[k], rounds * round_length, None, None) for k in \
+            sorted(running)]
+    finally:
+        pool.close()
+        pool.join()
+    
+    k = max(log_likelihoods, key=log_likelihoods.get)
+    print('Best run:', k, 'with log-likelihood', log_likelihoods[k])
+    state = load_checkpoint(paths[k])
+    grammar_format = arguments.get('grammar_format', 'text')
+    save_rules(state['unary_rules'], state['previous_rules'], nts, \
+    'output_best' + ('.bin' if grammar_format == 'binary' else '.txt'), \
+    grammar_format)
+    return k, state['previous_rules']
+
+def training(unary_rules, binary_rules, nts, i, engine='python', \
+batch_size=None, workers=None, corpus='training.txt', \
+unknown_words='ignore', prune_threshold=0.0, beam=None, \
+grammar_format='text', checkpoint=None, checkpoint_every=None, \
+max_iterations=None, log_dir='log', convergence='likelihood', \
+threshold=1e-04, metrics=None, callbacks=(), online=False, \
+step_offset=2.0, step_power=0.7, state=None):
     
     """Performs inside-outside training on a set of training sentences
         and a set of PCFG rules
-        Input: unary and binary rules and nonterminals; training.txt should
-        exist in directory; i: postfix of output.txt
+        Input: unary and binary rules and nonterminals; i: postfix of
+        output.txt; corpus: training file or directory of training files
+        (read anew in every iteration), binary corpus written by
+        encode_corpus(), or any re-iterable of sentences as lists of words;
+        engine: 'python' (sparse charts) or 'numpy' (dense arrays, requires
+        NumPy);
+        batch_size: if given, sentences of similar length are grouped into
+        batches of this size and rules are updated once per batch instead
+        of once per sentence; workers: if given, each iteration is a batch
+        EM pass whose expected counts are computed by this many worker
+        processes, and rules are updated once per iteration; unknown_words:
+        how to treat words without unary rules (see UNKNOWN_WORD_POLICIES);
+        prune_threshold, beam: if given, chart entries below prune_threshold
+        times the largest entry of their cell, or smaller than the beam
+        largest ones, are dropped (see prune_cell()); the discarded inside
+        mass is reported after every iteration; grammar_format: 'text'
+        (log/N.log, output_i.txt) or 'binary' (log/N.bin, output_i.bin, see
+        write_grammar()); checkpoint: if given, the grammar, the number of
+        iterations, the improvement history and the position in the corpus
+        are saved to this file after every iteration (see resume_training());
+        checkpoint_every: also save after every this many batches (or
+        sentences) within an iteration; max_iterations: if given, training
+        also stops after this many iterations; log_dir: directory of the
+        per-iteration grammars; convergence: 'likelihood' (training stops
+        when the relative change of the corpus log-likelihood, totalled
+        from the inside passes of an iteration, is below threshold in
+        either direction, see has_converged()) or 'rules'
+        (when no rule probability changes by threshold or more);
+        metrics: if given, the metrics of every iteration (see
+        iteration_metrics()) are appended to this file as a line of JSON;
+        callbacks: functions called with the metrics of every iteration (not
+        saved in checkpoints); online: if True, the batches (sentences, if
+        batch_size is not given) update the rules by stepwise online EM
+        with step_offset and step_power (see OnlineEM); its statistics are
+        kept across iterations, so rules are not pruned between iterations;
+        state: checkpoint to continue from
         Output: trained binary rules"""
         
-    # read training file
-    try:
-        with open('training.txt') as f:
-            sents = f.readlines()
-    except IOError:
-        print("Could not find file 'training.txt'")
+    if engine not in ('python', 'numpy'):
+        print("Unknown engine '" + str(engine) + "'")
+        sys.exit(-1)
+    if engine == 'numpy' and np is None:
+        print("The 'numpy' engine requires NumPy to be installed")
+        sys.exit(-1)
+    if batch_size is not None and batch_size < 1:
+        print("Batch size must be a positive integer")
         sys.exit(-1)
+    if workers is not None and workers < 1:
+        print("Number of workers must be a positive integer")
+        sys.exit(-1)
+    if unknown_words not in UNKNOWN_WORD_POLICIES:
+        print("Unknown word policy must be one of " + \
+        ', '.join(UNKNOWN_WORD_POLICIES))
+        sys.exit(-1)
+    if not 0.0 <= prune_threshold < 1.0:
+        print("Pruning threshold must be at least 0 and less than 1")
+        sys.exit(-1)
+    if beam is not None and beam < 1:
+        print("Beam width must be a positive integer")
+        sys.exit(-1)
+    if grammar_format not in GRAMMAR_FORMATS:
+        print("Grammar format must be one of " + ', '.join(GRAMMAR_FORMATS))
+        sys.exit(-1)
+    if checkpoint_every is not None and checkpoint_every < 1:
+        print("Checkpoint interval must be a positive integer")
+        sys.exit(-1)
+    if max_iterations is not None and max_iterations < 1:
+        print("Maximum number of iterations must be a positive integer")
+        sys.exit(-1)
+    if online and workers is not None:
+        print("Online training updates the rules after every batch and "
+        "cannot be combined with workers")
+        sys.exit(-1)
+    if convergence not in CONVERGENCE_CRITERIA:
+        print("Convergence criterion must be one of " + \
+        ', '.join(CONVERGENCE_CRITERIA))
+        sys.exit(-1)
+    arguments = {'engine': engine, 'batch_size': batch_size, 'workers': \
+    workers, 'corpus': corpus, 'unknown_words': unknown_words, \
+    'prune_threshold': prune_threshold, 'beam': beam, 'grammar_format': \
+    grammar_format, 'checkpoint': checkpoint, 'checkpoint_every': \
+    checkpoint_every, 'max_iterations': max_iterations, 'log_dir': log_dir, \
+    'convergence': convergence, 'threshold': threshold, 'metrics': metrics, \
+    'online': online, 'step_offset': step_offset, 'step_power': step_power}
+    log_ext, output_ext = ('.bin', '.bin') if grammar_format == 'binary' \
+    else ('.log', '.txt')
+        
+    # open training corpus
+    if isinstance(corpus, str):
+        corpus = open_corpus(corpus)
+    vocab = getattr(corpus, 'vocab', None)
         
     # create log dir
-    if not os.path.exists('log'):
-        os.makedirs('log')
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir)
     
-    iterations = 0
+    iterations, history, position = 0, [], 0
     ud_rules = binary_rules
-    # perform first iteration of training
-    #print('Original rules:\n', ud_rules)
-    print('Training ' + str(i) + '...\n')
-    for sent in sents:
-        words = sent.split()
-
-        inside_probs = inside(words, unary_rules, ud_rules, nts)
-        outside_probs = outside(words, inside_probs, ud_rules, nts)
-        ud_rules = train_iterate(words, inside_probs, outside_probs, \
-        ud_rules)
-        
-        #print(inside_probs)
-        #print(outside_probs)
-        
-    iterations += 1
-    #print('Updated rules after iteration', iterations, '\n', ud_rules)
-    print('Iteration', iterations)
-    print_rules(unary_rules, binary_rules, 'log/' + str(iterations) + '.log')
-    
-
-    # train until change in rule probabilities is higher than 1e-04
-    impr = check_improvement(binary_rules, ud_rules)
-    threshold = 1e-04
-    while impr >= threshold:
+    # sufficient statistics of online training
+    statistics = None
+    if state is not None:
+        iterations, history = state['iterations'], list(state['history'])
+        position, statistics = state['position'], state['statistics']
+        # output rules if the run has already converged
+        if state.get('previous_rules') is not None:
+            binary_rules = state['previous_rules']
+        print('Resuming training ' + str(i) + ' after iteration ' + \
+        str(iterations) + (', batch ' + str(position) if position else '') \
+        + '...\n')
+    else:
+        #print('Original rules:\n', ud_rules)
+        print('Training ' + str(i) + '...\n')
+
+    # train until the log-likelihood (or the rule probabilities) stop
+    # changing by at least threshold
+    converged = has_converged(history, convergence, threshold)
+    while not converged and (max_iterations is None or iterations < \
+    max_iterations):
     #while iterations < 2:
-        # get rid of zero probabilities
-        temp_u = []
-        for ud_rule in ud_rules:
-            if ud_rule[-1] != 0.0:
-                temp_u.append(ud_rule)
-        ud_rules = temp_u
+        if iterations > 0 and position == 0 and not online:
+            # get rid of zero probabilities
+            temp_u = []
+            for ud_rule in ud_rules:
+                if ud_rule[-1] != 0.0:
+                    temp_u.append(ud_rule)
+            ud_rules = temp_u
         binary_rules = ud_rules
+        start = time.perf_counter()
+        grammar = Grammar(unary_rules, binary_rules, nts, vocab, \
+        unknown_words, prune_threshold, beam)
+        if position:
+            # continue an interrupted iteration
+            grammar.binary_probs = list(state['binary_probs'])
+            grammar.add_stats(state['stats'])
+            start -= state['elapsed']
         
-        for sent in sents:
-            words = sent.split()
-            
-            inside_probs = inside(words, unary_rules, ud_rules, nts)
-            outside_probs = outside(words, inside_probs, ud_rules, nts)
-            ud_rules = train_iterate(words, inside_probs, outside_probs, \
-            ud_rules)
-            
-            #print(inside_probs)
-            #print(outside_probs)
+        if workers is not None:
+            grammar.binary_probs = parallel_pass(corpus, grammar, engine, \
+            batch_size, workers)
+        else:
+            if online:
+                learner = OnlineEM(grammar, step_offset, step_power, engine, \
+                statistics)
+            else:
+                dense = DenseGrammar(grammar) if engine == 'numpy' else None
+            if batch_size is None:
+                batches = ([words] for words in corpus)
+            else:
+                batches = sentence_batches(corpus, batch_size)
+            for batch in itertools.islice(batches, position, None):
+                if online:
+                    learner.update(batch)
+                    statistics = learner.statistics()
+                else:
+                    grammar.binary_probs = train_batch(batch, grammar, dense)
+                position += 1
+                if checkpoint is not None and checkpoint_every is not None \
+                and position % checkpoint_every == 0:
+                    save_checkpoint(checkpoint, training_state(i, \
+                    arguments, unary_rules, binary_rules, nts, grammar, \
+                    iterations, history, position, time.perf_counter() - \
+                    start, statistics))
             
+        ud_rules = grammar.binary_rules()
         iterations += 1
+        position = 0
         #print('Updated rules after iteration', iterations, '\n', ud_rules)
         impr = check_improvement(binary_rules, ud_rules)
-        print('Iteration', iterations, ";max improvment", impr)
-        print_rules(unary_rules, binary_rules, 'log/' + str(iterations) + \
-        '.log')
+        history.append((impr, grammar.log_likelihood))
+        converged = has_converged(history, convergence, threshold)
+        if iterations == 1:
+            print('Iteration', iterations)
+        else:
+            print('Iteration', iterations, ";max improvment", impr)
+        # totalled from the inside passes of the iteration: with workers,
+        # the log-likelihood of the grammar the iteration started from,
+        # otherwise summed while the rules change after every batch
+        gain = relative_gain(history)
+        print('Log-likelihood', grammar.log_likelihood, 'of', \
+        grammar.parsed_sentences, 'sentences' + ('' if gain is None else \
+        ', relative gain ' + str(gain) + (' (drop)' if gain < 0 else '')))
+        if grammar.pruning and grammar.pruned_cells:
+            print('Pruning discarded', '%.4f%%' % (100.0 * \
+            grammar.discarded_mass / grammar.pruned_cells), \
+            'of the inside mass of', grammar.pruned_cells, 'cells')
+        save_rules(unary_rules, binary_rules, nts, os.path.join(log_dir, \
+        str(iterations) + log_ext), grammar_format)
+        
+        if metrics is not None or callbacks:
+            iteration = iteration_metrics(i, iterations, grammar, history, \
+            time.perf_counter() - start)
+            if metrics is not None:
+                with open(metrics, 'a') as o:
+                    o.write(json.dumps(iteration, sort_keys=True) + '\n')
+            for callback in callbacks:
+                callback(iteration)
+        if checkpoint is not None:
+            save_checkpoint(checkpoint, training_state(i, arguments, \
+            unary_rules, ud_rules, nts, grammar, iterations, history, \
+            position, 0.0, statistics, binary_rules))
         
-    print('Training terminated because of too small improvement')
-    print_rules(unary_rules, binary_rules, 'output_' + str(i) + '.txt')
+    if not converged:
+        print('Training stopped after', iterations, 'iterations')
+    elif convergence == 'likelihood' and relative_gain(history) < 0:
+        print('Training terminated because the log-likelihood dropped by '
+        'less than the threshold')
+    else:
+        print('Training terminated because of too small improvement')
+    save_rules(unary_rules, binary_rules, nts, 'output_' + str(i) + \
+    output_ext, grammar_format)
     return ud_rules
     
 def check_prob(lines):
@@ -352,28 +1952,73 @@ def check_prob(lines):
 def set_initial_probabilities(rules):
     """Sets initial probabilities for rules, assuming uniform distribution
     Input: list of rule tuples
-    Output: list of rule tuples w\ uniform initial probabilities"""
+    Output: list of rule tuples with uniform initial probabilities"""
     
-    rule_set = set()
+    # number of rules of each left-hand side
+    counts = {}
     for rule in rules:
-        if rule[0] not in rule_set:
-            rule_set.add(rule[0])
-            count = 0
-            for r in rules:
-                if r[0] == rule[0]:
-                    count += 1
-                try:
-                    prob = 1.0 / count
-                except ZeroDivisionError:
-                    prob = 0.0
-                for i in range(0, len(rules)):
-                    if rules[i][0] == rule[0]:
-                        t = list(rules[i])
-                        t[-1] = prob
-                        rules[i] = tuple(t)
+        counts[rule[0]] = counts.get(rule[0], 0) + 1
                             
-    return rules
-                              
+    return [rule[:-1] + (1.0 / counts[rule[0]],) for rule in rules]
+
+def perturb_probabilities(rules, noise=0.5, seed=None):
+    """Randomly perturbs rule probabilities, e. g. to start grammar induction
+    from different points: every probability is multiplied by a factor drawn
+    uniformly from [1 - noise, 1 + noise], then the rules of each left-hand
+    side are rescaled to their original total probability.
+    Input: list of rule tuples, amount of noise (at least 0 and less than 1),
+    random seed
+    Output: list of rule tuples with perturbed probabilities"""
+    
+    if not 0.0 <= noise < 1.0:
+        print("Perturbation must be at least 0 and less than 1")
+        sys.exit(-1)
+    
+    uniform = random.Random(seed).uniform
+    probs = [rule[-1] * uniform(1.0 - noise, 1.0 + noise) for rule in rules]
+    
+    # old and new total probability of each left-hand side
+    totals, new_totals = {}, {}
+    for rule, prob in zip(rules, probs):
+        totals[rule[0]] = totals.get(rule[0], 0.0) + rule[-1]
+        new_totals[rule[0]] = new_totals.get(rule[0], 0.0) + prob
+        
+    return [rule[:-1] + (prob * totals[rule[0]] / new_totals[rule[0]] if \
+    prob > 0.0 else 0.0,) for rule, prob in zip(rules, probs)]
+    
+def read_rules(path):
+    """Reads a trained PCFG in the text format written by print_rules(),
+       where terminals are quoted, or in the binary format of
+       write_grammar().
+       Input: path of the rule file
+       Output: unary and binary rules, nonterminals in order of appearance"""
+    
+    unary_rules, binary_rules, nts = [], [], []
+    try:
+        with open(path, 'rb') as f:
+            if f.read(len(GRAMMAR_MAGIC)) == GRAMMAR_MAGIC:
+                return load_grammar(path)
+        with open(path) as f:
+            lines = f.readlines()
+    except IOError:
+        print("Could not find file '" + path + "'")
+        sys.exit(-1)
+    
+    for line in lines:
+        l = line.split()
+        if len(l) == 5: # binary rule
+            binary_rules.append((l[0], l[2], l[3], float(l[4])))
+        elif len(l) == 4: # unary rule
+            word = l[2]
+            if len(word) > 1 and word[0] == "'" and word[-1] == "'":
+                word = word[1:-1]
+            unary_rules.append((l[0], word, float(l[3])))
+        else:
+            continue
+        if l[0] not in nts:
+            nts.append(l[0])
+    
+    return unary_rules, binary_rules, nts
     
 def read_grammar():
     """Reads input files and builds the initial grammar.
@@ -452,17 +2097,6 @@ def read_grammar():
         for tline in tlines:
             ts.append(tline.split('\n')[0])
             
-        # create all CNF binary rules
-        try:
-            prob = 1.0 / ((len(nts) - 1) * (len(nts) - 2))
-        except ZeroDivisionError:
-            prob = 0.0
-        for nt_start in nts:
-            for nt_left in nts:
-                for nt_right in nts:
-                        binary_rules.append((nt_start, nt_left, nt_right,\
-                        prob))
-        
         # look for unary rules        
         if os.path.exists('pos.txt'):
             with open('pos.txt') as f:
@@ -489,14 +2123,6 @@ def read_grammar():
                    p = pline.split()
                    unary_rules.append((p[0], p[2], 0.0))
                unary_rules = set_initial_probabilities(unary_rules)
-               
-            # delete 'pos tags' producing nonterminals
-            for unary_rule in unary_rules:
-                for i in range(0, len(binary_rules)):
-                    if binary_rules[i][0] == unary_rule[0]:
-                       t = list(binary_rules[i])
-                       t[-1] = 0.0
-                       binary_rules[i] = tuple(t)
                     
         else:
             # create all teminal productions        
@@ -507,17 +2133,157 @@ def read_grammar():
             for nt_start in nts:
                 for t in ts:
                     unary_rules.append((nt_start, t, prob))
+        
+        # 'pos tags' producing nonterminals get no binary rules
+        pos_tags = set(unary_rule[0] for unary_rule in unary_rules) if \
+        os.path.exists('pos.txt') else set()
+                    
+        # create all CNF binary rules
+        try:
+            prob = 1.0 / ((len(nts) - 1) * (len(nts) - 2))
+        except ZeroDivisionError:
+            prob = 0.0
+        for nt_start in nts:
+            if nt_start in pos_tags:
+                continue
+            for nt_left in nts:
+                for nt_right in nts:
+                        binary_rules.append((nt_start, nt_left, nt_right,\
+                        prob))
                     
     # get rid of zero probabilities
-    temp_b = []
-    for binary_rule in binary_rules:
-        if binary_rule[-1] != 0.0:
-            temp_b.append(binary_rule)
-    binary_rules = temp_b
+    binary_rules = [binary_rule for binary_rule in binary_rules if \
+    binary_rule[-1] != 0.0]
     
     return unary_rules, binary_rules, nts
 if __name__ == '__main__':
     
-    unary_rules, binary_rules, nts = read_grammar()
-    ud_rules = training(unary_rules, binary_rules, nts, 0)
+    parser = argparse.ArgumentParser(description='Inside-outside training '
+    'of PCFGs')
+    parser.add_argument('--corpus', default='training.txt', help='training '
+    'corpus: text file, directory of text files or encoded corpus')
+    parser.add_argument('--unknown-words', default='ignore', 
+    choices=UNKNOWN_WORD_POLICIES, help='treatment of words without unary '
+    'rules')
+    parser.add_argument('--prune-threshold', type=float, default=0.0, 
+    help='drop chart entries below this fraction of the largest entry of '
+    'their cell')
+    parser.add_argument('--beam', type=int, help='keep only this many '
+    'entries per chart cell')
+    parser.add_argument('--grammar', help='initial grammar written by an '
+    'earlier run (text or binary) instead of pcfg.txt')
+    parser.add_argument('--grammar-format', default='text', 
+    choices=GRAMMAR_FORMATS, help='format of the log and output grammars')
+    parser.add_argument('--perturb', type=float, metavar='NOISE', 
+    help='randomly perturb the initial binary rule probabilities by up to '
+    'this fraction')
+    parser.add_argument('--seed', type=int, help='random seed of --perturb and '
+    '--restarts')
+    parser.add_argument('--batch-size', type=int, help='number of sentences '
+    'per update (default: 1, or 32 with --online)')
+    parser.add_argument('--online', metavar='STATE', help='update the '
+    'grammar kept in this state file (created from the initial grammar if '
+    'it does not exist) with the sentences of --corpus by stepwise online '
+    'EM, and write it to output_online.txt')
+    parser.add_argument('--stepwise', action='store_true', help='train by '
+    'stepwise online EM over the batches of every pass instead of '
+    're-estimating the rules from each batch alone')
+    parser.add_argument('--step-offset', type=float, default=2.0, 
+    help='offset of the online EM step size (k + offset) ** -power')
+    parser.add_argument('--step-power', type=float, default=0.7, 
+    help='power of the online EM step size, greater than 0.5 and at most 1')
+    parser.add_argument('--workers', type=int, help='number of worker '
+    'processes (of a batch EM pass, of parsing or of --restarts)')
+    parser.add_argument('--restarts', type=int, metavar='K', help='train K '
+    'randomly perturbed copies of the grammar in parallel, stop those that '
+    'fall behind and keep the best one')
+    parser.add_argument('--round-length', type=int, default=5, metavar='N', 
+    help='with --restarts, compare the runs every N iterations')
+    parser.add_argument('--margin', type=float, default=0.05, help='with '
+    '--restarts, stop runs whose log-likelihood is more than this share of '
+    'the best one behind it')
+    parser.add_argument('--parse', metavar='GRAMMAR', help='parse sentences '
+    'from standard input with a trained grammar (e.g. output_0.txt) and '
+    'write their most probable trees to standard output')
+    parser.add_argument('--log-prob', action='store_true', help='with '
+    '--parse, prefix every tree with its log probability')
+    parser.add_argument('--convergence', default='likelihood', 
+    choices=CONVERGENCE_CRITERIA, help='stop when the relative change of the '
+    'corpus log-likelihood, up or down (likelihood), or the largest change '
+    'of a rule probability (rules) is below --threshold')
+    parser.add_argument('--threshold', type=float, default=1e-04, 
+    help='convergence threshold')
+    parser.add_argument('--metrics', metavar='FILE', help='append the '
+    'metrics of every iteration to this file as JSON lines')
+    parser.add_argument('--checkpoint', help='save a checkpoint to this '
+    'file after every iteration')
+    parser.add_argument('--checkpoint-every', type=int, metavar='N', 
+    help='with --checkpoint, also save after every N batches (or sentences)')
+    parser.add_argument('--resume', metavar='CHECKPOINT', help='continue an '
+    'interrupted run from its checkpoint')
+    parser.add_argument('--encode-corpus', nargs=2, metavar=('SOURCE', 
+    'TARGET'), help='convert a text corpus into the binary format and exit')
+    args = parser.parse_args()
+    
+    if args.encode_corpus:
+        n_sents = encode_corpus(args.encode_corpus[0], args.encode_corpus[1])
+        print('Encoded', n_sents, 'sentences')
+        sys.exit(0)
+    
+    if args.parse:
+        unary_rules, binary_rules, nts = read_rules(args.parse)
+        grammar = Grammar(unary_rules, binary_rules, nts, \
+        unknown_words=args.unknown_words, \
+        prune_threshold=args.prune_threshold, beam=args.beam)
+        sents = (line.split() for line in sys.stdin)
+        for tree, log_prob in parse_sentences(sents, grammar, args.workers):
+            # sentences without a parse give an empty line
+            if args.log_prob:
+                sys.stdout.write(str(log_prob) + '\t')
+            sys.stdout.write((tree or '') + '\n')
+        sys.exit(0)
+    
+    if args.resume:
+        resume_training(args.resume)
+        sys.exit(0)
+    
+    if args.online:
+        # the initial grammar is only needed to create the state file
+        rules = None
+        if not os.path.exists(args.online):
+            rules = read_rules(args.grammar) if args.grammar else \
+            read_grammar()
+        unary_rules, binary_rules, nts = online_update(args.online, \
+        args.corpus, rules, args.batch_size or 32, args.step_offset, \
+        args.step_power, unknown_words=args.unknown_words)
+        save_rules(unary_rules, binary_rules, nts, 'output_online' + \
+        ('.bin' if args.grammar_format == 'binary' else '.txt'), \
+        args.grammar_format)
+        sys.exit(0)
+    
+    if args.grammar:
+        unary_rules, binary_rules, nts = read_rules(args.grammar)
+    else:
+        unary_rules, binary_rules, nts = read_grammar()
+    if args.restarts:
+        random_restarts(unary_rules, binary_rules, nts, args.restarts, \
+        0.5 if args.perturb is None else args.perturb, args.seed, \
+        args.workers, args.round_length, args.margin, \
+        batch_size=args.batch_size, corpus=args.corpus, \
+        unknown_words=args.unknown_words, \
+        prune_threshold=args.prune_threshold, beam=args.beam, \
+        grammar_format=args.grammar_format, convergence=args.convergence, \
+        threshold=args.threshold, metrics=args.metrics)
+        sys.exit(0)
+    if args.perturb:
+        binary_rules = perturb_probabilities(binary_rules, args.perturb, \
+        args.seed)
+    ud_rules = training(unary_rules, binary_rules, nts, 0, \
+    batch_size=args.batch_size, corpus=args.corpus, workers=args.workers, \
+    unknown_words=args.unknown_words, \
+    prune_threshold=args.prune_threshold, beam=args.beam, \
+    grammar_format=args.grammar_format, checkpoint=args.checkpoint, \
+    checkpoint_every=args.checkpoint_every, convergence=args.convergence, \
+    threshold=args.threshold, metrics=args.metrics, online=args.stepwise, \
+    step_offset=args.step_offset, step_power=args.step_power)
     
\ No newline at end of file